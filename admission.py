@@ -0,0 +1,120 @@
+import logging
+import threading
+from typing import Callable, Dict, Optional
+
+# Decides if the appservice accepts a pushed transaction, based on the
+# matrix to murmur work the bridge has not done yet: queued messages and
+# transactions in flight, and images in flight. Work in the other direction
+# is not counted, rejecting transactions would not make it any less. Once
+# one of them reaches its high-water mark transactions are rejected with a
+# retryable error, so the matrix server backs off instead of piling up more
+# work, until both are down to their low-water marks again. A high-water
+# mark of 0 disables that check.
+
+# Backlog of the bridge: "queued" messages, "transactions" which are being
+# processed, they count as queued, and "images" in flight.
+Backlog = Dict[str, int]
+
+
+class AdmissionControl:
+    def __init__(
+        self,
+        high_water: int = 800,
+        low_water: int = 400,
+        image_high_water: int = 32,
+        image_low_water: int = 16,
+        retry_after: float = 5.0,
+    ):
+        self._high_water = high_water
+        self._low_water = min(low_water, high_water)
+        self._image_high_water = image_high_water
+        self._image_low_water = min(image_low_water, image_high_water)
+        self._retry_after = retry_after
+        self._backlog_cb: Optional[Callable[[], Backlog]] = None
+
+        self._lock = threading.Lock()
+        self._shedding = False
+        self._rejected = 0
+        self._transactions = 0
+
+    @property
+    def backlog_cb(self) -> Callable[[], Backlog]:
+        return self._backlog_cb
+
+    @backlog_cb.setter
+    def backlog_cb(self, cb: Callable[[], Backlog]):
+        self._backlog_cb = cb
+
+    @property
+    def retry_after(self) -> float:
+        return self._retry_after
+
+    @property
+    def shedding(self) -> bool:
+        return self._shedding
+
+    @property
+    def rejected(self) -> int:
+        return self._rejected
+
+    def backlog(self) -> Backlog:
+        if self._backlog_cb is None:
+            backlog = {"queued": 0, "images": 0}
+        else:
+            backlog = dict(self._backlog_cb())
+        backlog["transactions"] = self._transactions
+        return backlog
+
+    def admit(self) -> bool:
+        # An admitted transaction has to be ended with done.
+        backlog = self.backlog()
+        with self._lock:
+            shedding = self._update(backlog)
+            if shedding:
+                self._rejected += 1
+            else:
+                self._transactions += 1
+            return not shedding
+
+    def done(self):
+        with self._lock:
+            self._transactions -= 1
+
+    def check(self) -> Backlog:
+        # Updates the state without a transaction, e.g. for a readiness probe.
+        backlog = self.backlog()
+        with self._lock:
+            self._update(backlog)
+        return backlog
+
+    def _update(self, backlog: Backlog) -> bool:
+        # Called with the lock held, returns if transactions are rejected.
+        queued = backlog["queued"] + backlog["transactions"]
+        images = backlog["images"]
+        if self._shedding:
+            if self._below(queued, images):
+                self._shedding = False
+                logging.info(
+                    "backlog is down to %d jobs and %d images, accepting "
+                    "transactions again",
+                    queued,
+                    images,
+                )
+        elif self._above(queued, images):
+            self._shedding = True
+            logging.warning(
+                "backlog of %d jobs and %d images, rejecting transactions",
+                queued,
+                images,
+            )
+        return self._shedding
+
+    def _above(self, queued: int, images: int) -> bool:
+        return (0 < self._high_water <= queued) or (
+            0 < self._image_high_water <= images
+        )
+
+    def _below(self, queued: int, images: int) -> bool:
+        return (self._high_water <= 0 or queued <= self._low_water) and (
+            self._image_high_water <= 0 or images <= self._image_low_water
+        )
@@ -0,0 +1,293 @@
+import argparse
+import base64
+import io
+import json
+import logging
+import multiprocessing
+import os
+import platform
+import resource
+import statistics
+import subprocess
+import tempfile
+import threading
+import time
+from typing import Callable, Dict
+
+from PIL import Image
+
+from benchmarks.fakes import FakeHomeserver, FakeMurmur, find_free_port, wait_for_port
+from main import MandMBridge
+
+# End-to-end benchmark of the bridge against a fake homeserver and a fake
+# murmur server, both running in this process.
+# Run from the repository root with: python3 -m benchmarks.bench_bridge
+# The results are written as json, compare two runs with benchmarks.compare.
+
+CONFIG = """
+[matrix]
+Address = {homeserver}
+ServerName = bench.local
+RateLimit = 0
+PuppetRateLimit = 0
+
+[appservice]
+ApplicationServicePort = {port}
+ApplicationServiceIP = 127.0.0.1
+Room = bench
+UserPrefix = mumble_
+ApplicationServiceToken = bench
+HomeserverToken = bench
+Backend = {backend}
+
+[murmur]
+Address = 127.0.0.1
+Port = {murmur_port}
+ServerId = 1
+Secret = bench
+
+[bridge]
+Database = {database}
+Journal = {journal}
+CoalesceWindow = {coalesce_window}
+
+[murmur_remove_html]
+Enabled = 1
+"""
+
+
+def make_image(size: int) -> bytes:
+    img = Image.frombytes("RGB", (size, size), os.urandom(size * size * 3))
+    with io.BytesIO() as output:
+        img.save(output, format="jpeg", quality=90)
+        return output.getvalue()
+
+
+def rss_mb() -> float:
+    with open("/proc/self/statm", encoding="ascii") as file:
+        pages = int(file.read().split()[1])
+    return pages * resource.getpagesize() / 1024 / 1024
+
+
+def measure(
+    count: int,
+    fire: Callable[[int], None],
+    wait: Callable[[int, float], Dict[str, float]],
+    timeout: float,
+) -> dict:
+    sent: Dict[str, float] = {}
+    start = time.perf_counter()
+    for i in range(count):
+        sent[str(i)] = time.perf_counter()
+        fire(i)
+    arrivals = wait(count, timeout)
+    latencies = sorted(
+        (arrivals[marker] - sent[marker]) * 1000
+        for marker in arrivals
+        if marker in sent
+    )
+    end = max(arrivals.values(), default=start)
+    result = {
+        "count": count,
+        "lost": count - len(latencies),
+        "seconds": round(end - start, 4),
+        "msgs_per_sec": round(len(latencies) / (end - start), 1) if end > start else 0,
+        "rss_mb": round(rss_mb(), 1),
+        "max_rss_mb": round(
+            resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1
+        ),
+    }
+    if latencies:
+        result["p50_ms"] = round(statistics.median(latencies), 3)
+        result["p99_ms"] = round(
+            latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))], 3
+        )
+    return result
+
+
+class Harness:
+    def __init__(
+        self,
+        backend: str,
+        channels: int,
+        journal: bool = False,
+        coalesce_window: float = 0.0,
+    ):
+        self.homeserver = FakeHomeserver()
+        self.homeserver.start()
+        self.murmur = FakeMurmur(channels)
+        self._tmp = tempfile.TemporaryDirectory()
+
+        port = find_free_port()
+        self.appservice = f"http://127.0.0.1:{port}"
+        config = os.path.join(self._tmp.name, "bridge.conf")
+        with open(config, "w", encoding="utf-8") as file:
+            file.write(
+                CONFIG.format(
+                    homeserver=self.homeserver.address,
+                    port=port,
+                    backend=backend,
+                    murmur_port=self.murmur.port,
+                    database=os.path.join(self._tmp.name, "bridge.db"),
+                    journal=(
+                        os.path.join(self._tmp.name, "bridge.journal")
+                        if journal
+                        else ""
+                    ),
+                    coalesce_window=coalesce_window,
+                )
+            )
+        self.bridge = MandMBridge(config)
+
+    def start(self):
+        self.bridge.setup()
+        threading.Thread(target=self.bridge.do_bridge, daemon=True).start()
+        if not wait_for_port(self.appservice) or not self.murmur.wait_for_callback():
+            raise RuntimeError("bridge did not start")
+
+
+def run(harness: Harness, count: int, timeout: float) -> Dict[str, dict]:
+    homeserver = harness.homeserver
+    murmur = harness.murmur
+    results = {}
+
+    def matrix_text(i: int):
+        homeserver.push_transaction(
+            harness.appservice, [homeserver.text_event("alice", f"hello bench-{i}")]
+        )
+
+    murmur.arrivals.clear()
+    results["matrix_to_murmur_text"] = measure(
+        count, matrix_text, murmur.arrivals.wait, timeout
+    )
+
+    # A backlog after a hiccup of the matrix server, many events per
+    # transaction. Also reports the resulting ice calls.
+    backlog = 50
+
+    def matrix_backlog(i: int):
+        if i % backlog == backlog - 1 or i == count - 1:
+            homeserver.push_transaction(
+                harness.appservice,
+                [
+                    homeserver.text_event("alice", f"hello bench-{j}")
+                    for j in range(i - i % backlog, i + 1)
+                ],
+            )
+
+    murmur.arrivals.clear()
+    messages = murmur.messages
+    results["matrix_to_murmur_backlog"] = measure(
+        count, matrix_backlog, murmur.arrivals.wait, timeout
+    )
+    results["matrix_to_murmur_backlog"]["ice_calls"] = murmur.messages - messages
+
+    image_count = max(1, count // 10)
+    images = [homeserver.add_media(make_image(1024)) for _ in range(image_count)]
+
+    def matrix_image(i: int):
+        # The marker is not part of the image, it is recorded by sender name.
+        homeserver.push_transaction(
+            harness.appservice,
+            [homeserver.image_event(f"bench-{i}", images[i], "a.jpg")],
+        )
+
+    murmur.arrivals.clear()
+    results["matrix_to_murmur_image"] = measure(
+        image_count, matrix_image, murmur.arrivals.wait, timeout
+    )
+
+    def murmur_text(i: int):
+        murmur.fire_text("alice", f"hello bench-{i}")
+
+    homeserver.clear()
+    results["murmur_to_matrix_text"] = measure(
+        count, murmur_text, homeserver.arrivals.wait, timeout
+    )
+
+    encoded = [
+        base64.b64encode(make_image(256)).decode("ascii") for _ in range(image_count)
+    ]
+
+    def murmur_image(i: int):
+        # The fake homeserver records the n-th image as marker n.
+        murmur.fire_text("alice", f'<img src="data:image/jpeg;base64,{encoded[i]}" />')
+
+    homeserver.clear()
+    results["murmur_to_matrix_image"] = measure(
+        image_count, murmur_image, homeserver.arrivals.wait, timeout
+    )
+
+    def connect(i: int):
+        murmur.fire_connected(f"bench-{i}", i + 100)
+
+    homeserver.clear()
+    results["connect_storm"] = measure(
+        count, connect, homeserver.arrivals.wait, timeout
+    )
+    return results
+
+
+def git_revision() -> str:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def main():
+    args_parser = argparse.ArgumentParser(description="MandM-bridge benchmark")
+    args_parser.add_argument("-n", "--count", type=int, default=500)
+    args_parser.add_argument("-c", "--channels", type=int, default=10)
+    args_parser.add_argument("-b", "--backend", default="threaded")
+    args_parser.add_argument("-t", "--timeout", type=float, default=60.0)
+    args_parser.add_argument(
+        "-j", "--journal", action="store_true", help="enable the message journal"
+    )
+    args_parser.add_argument(
+        "-w",
+        "--coalesce-window",
+        type=float,
+        default=0.0,
+        help="seconds over which matrix messages are merged",
+    )
+    args_parser.add_argument("-o", "--output", default="bench_output.json")
+    args = args_parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+
+    harness = Harness(args.backend, args.channels, args.journal, args.coalesce_window)
+    harness.start()
+    results = run(harness, args.count, args.timeout)
+
+    output = {
+        "meta": {
+            "revision": git_revision(),
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "python": platform.python_version(),
+            "backend": args.backend,
+            "channels": args.channels,
+            "journal": args.journal,
+            "coalesce_window": args.coalesce_window,
+            "count": args.count,
+        },
+        "results": results,
+    }
+    with open(args.output, "w", encoding="utf-8") as file:
+        json.dump(output, file, indent=2)
+    for name, result in results.items():
+        print(f"{name:25} {json.dumps(result)}")
+    # The bridge and the fakes are not meant to be stopped, exit right away.
+    # Only the image worker processes would outlive this one.
+    for child in multiprocessing.active_children():
+        child.terminate()
+    os._exit(0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,46 @@
+import argparse
+import time
+
+from msghandlers import available_msg_handlers, build_handler_chains
+
+# Measures the cost of every message handler and of the compiled chains.
+# Run from the repository root with: python3 -m benchmarks.bench_handlers
+
+MESSAGES = [
+    "hello",
+    "a normal sentence in a chat, nothing special about it " * 4,
+    'look at <a href="https://example.org/some/path">https://example.org/some/path</a>',
+    "x" * 900,
+]
+
+
+def bench(handler, iterations: int) -> float:
+    start = time.perf_counter()
+    for _ in range(iterations):
+        for msg in MESSAGES:
+            handler("someone", msg)
+    return (time.perf_counter() - start) / (iterations * len(MESSAGES))
+
+
+def main():
+    args_parser = argparse.ArgumentParser(description="message handler benchmark")
+    args_parser.add_argument("-n", "--iterations", type=int, default=20000)
+    args = args_parser.parse_args()
+
+    handlers = {}
+    for name, load in available_msg_handlers().items():
+        handler = load()
+        if handler is not None:
+            handlers[name] = handler
+    for name, handler in sorted(handlers.items()):
+        print(f"{name:40} {bench(handler, args.iterations) * 1e9:10.0f} ns/msg")
+
+    for direction, chain in build_handler_chains(handlers).items():
+        print(
+            f"{direction + ' chain (' + str(len(chain)) + ' handlers)':40} "
+            f"{bench(chain, args.iterations) * 1e9:10.0f} ns/msg"
+        )
+
+
+if __name__ == "__main__":
+    main()
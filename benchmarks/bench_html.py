@@ -0,0 +1,77 @@
+import argparse
+import re
+import time
+from typing import Callable, Dict
+
+from htmlconvert import convert_html, unwrap_links
+
+# Measures the html handling of murmur messages on growing adversarial
+# inputs. The time per character should stay flat for linear code.
+# Run from the repository root with: python3 -m benchmarks.bench_html
+
+# The link pattern which was used by murmur_remove_html before, for comparison.
+GREEDY_LINK_RE = re.compile('<a href="(.*)">.*<\\/a>')
+
+INPUTS: Dict[str, Callable[[int], str]] = {
+    "many_links": lambda n: '<a href="https://e.org">e</a> ' * (n // 32),
+    "unclosed_links": lambda n: '<a href="x">' * (n // 12),
+    "unclosed_tags": lambda n: "<a " * (n // 3),
+    "nested_tags": lambda n: "<b><i>" * (n // 14) + "x" + "</i></b>" * (n // 14),
+    "escapes": lambda n: "<>&" * (n // 3),
+    "plain_text": lambda n: "word " * (n // 5),
+}
+
+FUNCTIONS: Dict[str, Callable[[str], object]] = {
+    "greedy_regex": lambda msg: GREEDY_LINK_RE.sub("\\1", msg),
+    "unwrap_links": unwrap_links,
+    "convert_html": lambda msg: convert_html(msg, 4000),
+}
+
+
+def bench(function: Callable[[str], object], msg: str, budget: float) -> float:
+    runs = 0
+    start = time.perf_counter()
+    while True:
+        function(msg)
+        runs += 1
+        elapsed = time.perf_counter() - start
+        if elapsed > budget:
+            return elapsed / runs
+
+
+def main():
+    args_parser = argparse.ArgumentParser(description="html conversion benchmark")
+    args_parser.add_argument(
+        "-s", "--sizes", default="1000,4000,16000,64000", help="input sizes in chars"
+    )
+    args_parser.add_argument(
+        "-b", "--budget", type=float, default=0.2, help="seconds per measurement"
+    )
+    args_parser.add_argument(
+        "--max-seconds",
+        type=float,
+        default=1.0,
+        help="larger inputs are skipped once a single run took this long",
+    )
+    args = args_parser.parse_args()
+    sizes = [int(size) for size in args.sizes.split(",")]
+
+    print(f"{'input':16} {'function':14}" + "".join(f"{s:>12}" for s in sizes))
+    print(f"{'':31}" + "".join(f"{'ns/char':>12}" for _ in sizes))
+    for input_name, make_input in INPUTS.items():
+        for function_name, function in FUNCTIONS.items():
+            row = f"{input_name:16} {function_name:14}"
+            too_slow = False
+            for size in sizes:
+                if too_slow:
+                    row += f"{'-':>12}"
+                    continue
+                msg = make_input(size)
+                seconds = bench(function, msg, args.budget)
+                too_slow = seconds > args.max_seconds
+                row += f"{seconds / max(1, len(msg)) * 1e9:12.0f}"
+            print(row)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,122 @@
+import argparse
+import io
+import os
+import time
+from typing import Callable, Dict, List, Tuple
+
+from PIL import Image, ImageFilter
+
+from imagepipeline import MESSAGE_OVERHEAD
+from utils import fit_image
+
+# Measures how long images posted in matrix take to get ready for murmur,
+# comparing the previous resize function with the current one.
+# Run from the repository root with: python3 -m benchmarks.bench_images
+# Pass a directory of real photos with -d, otherwise synthetic photo-like
+# images are generated.
+
+
+def ensure_image_size(
+    image: bytes, format: str, max_width: int = 600, max_height: int = 450
+) -> bytes:
+    # The resize function which was used before, for comparison.
+    img = Image.open(io.BytesIO(image))
+    img.thumbnail((max_width, max_height), Image.Resampling.LANCZOS)
+    with io.BytesIO() as output:
+        img.save(output, format=format)
+        return output.getvalue()
+
+
+def synthetic_image(width: int, height: int, format: str) -> bytes:
+    # Blurred noise over a gradient compresses about like a photo.
+    noise = Image.effect_noise((width // 4, height // 4), 64).resize((width, height))
+    gradient = Image.linear_gradient("L").resize((width, height))
+    img = Image.merge(
+        "RGB", (noise, gradient, noise.transpose(Image.Transpose.FLIP_LEFT_RIGHT))
+    )
+    img = img.filter(ImageFilter.GaussianBlur(1))
+    with io.BytesIO() as output:
+        img.save(output, format=format, quality=90)
+        return output.getvalue()
+
+
+def load_corpus(directory: str) -> List[Tuple[str, bytes, str]]:
+    corpus = []
+    for name in sorted(os.listdir(directory)):
+        with open(os.path.join(directory, name), "rb") as file:
+            data = file.read()
+        format = "png" if name.lower().endswith(".png") else "jpeg"
+        corpus.append((name, data, format))
+    return corpus
+
+
+def synthetic_corpus() -> List[Tuple[str, bytes, str]]:
+    return [
+        ("phone_4032x3024.jpg", synthetic_image(4032, 3024, "jpeg"), "jpeg"),
+        ("camera_1920x1080.jpg", synthetic_image(1920, 1080, "jpeg"), "jpeg"),
+        ("web_800x600.jpg", synthetic_image(800, 600, "jpeg"), "jpeg"),
+        ("small_500x375.jpg", synthetic_image(500, 375, "jpeg"), "jpeg"),
+        ("photo_1920x1080.png", synthetic_image(1920, 1080, "png"), "png"),
+        ("small_400x300.png", synthetic_image(400, 300, "png"), "png"),
+    ]
+
+
+def bench(function: Callable[[], bytes], budget: float) -> Tuple[float, int]:
+    runs = 0
+    start = time.perf_counter()
+    while True:
+        size = len(function())
+        runs += 1
+        elapsed = time.perf_counter() - start
+        if elapsed > budget:
+            return elapsed / runs, size
+
+
+def main():
+    args_parser = argparse.ArgumentParser(description="image resize benchmark")
+    args_parser.add_argument("-d", "--directory", help="directory of photos to use")
+    args_parser.add_argument(
+        "-l",
+        "--max-message-length",
+        type=int,
+        default=131072,
+        help="imagemessagelength of murmur, 0 for no limit",
+    )
+    args_parser.add_argument(
+        "-b", "--budget", type=float, default=0.5, help="seconds per measurement"
+    )
+    args = args_parser.parse_args()
+    corpus = load_corpus(args.directory) if args.directory else synthetic_corpus()
+    max_bytes = 0
+    if args.max_message_length > 0:
+        max_bytes = (args.max_message_length - MESSAGE_OVERHEAD) * 3 // 4
+
+    functions: Dict[str, Callable[[bytes, str], bytes]] = {
+        "before": ensure_image_size,
+        "fit_image": lambda data, format: fit_image(data, format, (600, 450))[0],
+        "fit_budget": lambda data, format: fit_image(
+            data, format, (600, 450), max_bytes
+        )[0],
+    }
+    print(f"{'image':24} {'input kB':>9}" + "".join(f"{n:>22}" for n in functions))
+    print(f"{'':34}" + "".join(f"{'ms':>11}{'kB':>11}" for _ in functions))
+    totals = {name: 0.0 for name in functions}
+    for name, data, format in corpus:
+        row = f"{name[:24]:24} {len(data) / 1024:9.0f}"
+        for function_name, function in functions.items():
+            seconds, size = bench(lambda: function(data, format), args.budget)
+            totals[function_name] += seconds
+            row += f"{seconds * 1000:11.1f}{size / 1024:11.0f}"
+        print(row)
+    print(
+        f"{'total':34}"
+        + "".join(f"{totals[name] * 1000:11.1f}{'':11}" for name in functions)
+    )
+    for name in functions:
+        if name != "before":
+            print(f"speedup of {name}: {totals['before'] / totals[name]:.1f}x")
+    print(f"byte budget: {max_bytes / 1024:.0f} kB" if max_bytes else "no byte budget")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,36 @@
+import argparse
+import json
+
+# Compares two result files of benchmarks.bench_bridge.
+# Run from the repository root with:
+# python3 -m benchmarks.compare old.json new.json
+
+METRICS = ("msgs_per_sec", "p50_ms", "p99_ms", "max_rss_mb", "lost")
+
+
+def main():
+    args_parser = argparse.ArgumentParser(description="compare benchmark results")
+    args_parser.add_argument("old")
+    args_parser.add_argument("new")
+    args = args_parser.parse_args()
+
+    with open(args.old, encoding="utf-8") as file:
+        old = json.load(file)
+    with open(args.new, encoding="utf-8") as file:
+        new = json.load(file)
+
+    print(f"old: {old['meta']}\nnew: {new['meta']}\n")
+    for scenario, new_result in new["results"].items():
+        old_result = old["results"].get(scenario, {})
+        print(scenario)
+        for metric in METRICS:
+            old_value = old_result.get(metric)
+            new_value = new_result.get(metric)
+            if old_value is None or new_value is None:
+                continue
+            change = (new_value - old_value) / old_value * 100 if old_value else 0.0
+            print(f"  {metric:14} {old_value:>12} {new_value:>12} {change:+8.1f}%")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,283 @@
+import json
+import re
+import socket
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List
+from urllib.parse import parse_qs, urlparse
+
+import Ice
+import requests
+
+from murmur.slice import Murmur
+
+# Stand-ins for a matrix homeserver and a murmur server, used by the
+# benchmarks. Both record when a bridged message arrives, messages are
+# recognized by a "bench-<number>" marker in their text or user name.
+
+MARKER_RE = re.compile(r"bench-(\d+)")
+
+
+class Arrivals:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._times: Dict[str, float] = {}
+        self._event = threading.Condition(self._lock)
+
+    def record(self, text: str):
+        now = time.perf_counter()
+        with self._lock:
+            for marker in MARKER_RE.findall(text):
+                self._times.setdefault(marker, now)
+            self._event.notify_all()
+
+    def clear(self):
+        with self._lock:
+            self._times.clear()
+
+    def wait(self, count: int, timeout: float) -> Dict[str, float]:
+        deadline = time.monotonic() + timeout
+        with self._lock:
+            while len(self._times) < count:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self._event.wait(remaining)
+            return dict(self._times)
+
+
+class FakeHomeserver:
+    def __init__(
+        self, domain: str = "bench.local", room_id: str = "!bench:bench.local"
+    ):
+        self.domain = domain
+        self.room_id = room_id
+        self.arrivals = Arrivals()
+        self.joined: Dict[str, bool] = {}
+        self.media: Dict[str, bytes] = {}
+        # Images carry no marker, the n-th image is recorded as marker n.
+        self._images = 0
+        self._lock = threading.Lock()
+
+        self._server = ThreadingHTTPServer(("127.0.0.1", 0), self._handler())
+        self._server.daemon_threads = True
+        self.address = f"http://127.0.0.1:{self._server.server_port}"
+        self._http = requests.Session()
+
+    def start(self):
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+
+    def clear(self):
+        with self._lock:
+            self._images = 0
+        self.arrivals.clear()
+
+    def add_media(self, data: bytes) -> str:
+        media_id = uuid.uuid4().hex
+        self.media[media_id] = data
+        return f"mxc://{self.domain}/{media_id}"
+
+    def push_transaction(self, appservice: str, events: List[dict]) -> int:
+        res = self._http.put(
+            f"{appservice}/_matrix/app/v1/transactions/{uuid.uuid4().hex}",
+            json={"events": events},
+        )
+        return res.status_code
+
+    def text_event(self, sender: str, body: str) -> dict:
+        return {
+            "type": "m.room.message",
+            "event_id": "$" + uuid.uuid4().hex,
+            "room_id": self.room_id,
+            "user_id": f"@{sender}:{self.domain}",
+            "sender": f"@{sender}:{self.domain}",
+            "content": {"msgtype": "m.text", "body": body},
+        }
+
+    def image_event(self, sender: str, mxc_url: str, name: str) -> dict:
+        event = self.text_event(sender, name)
+        event["content"] = {"msgtype": "m.image", "body": name, "url": mxc_url}
+        return event
+
+    def _handler(self):
+        homeserver = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+            # Headers and body are separate writes, with nagle the body of a
+            # keep-alive response waits for the delayed ack of the client.
+            disable_nagle_algorithm = True
+
+            def log_message(self, *_):
+                pass
+
+            def do_GET(self):
+                self._handle()
+
+            def do_PUT(self):
+                self._handle()
+
+            def do_POST(self):
+                self._handle()
+
+            def _handle(self):
+                length = int(self.headers.get("Content-Length") or 0)
+                body = self.rfile.read(length) if length else b""
+                url = urlparse(self.path)
+                user_id = parse_qs(url.query).get("user_id", [""])[0]
+                status, payload = homeserver._route(
+                    self.command, url.path, user_id, body
+                )
+                if isinstance(payload, dict):
+                    payload = json.dumps(payload).encode("utf-8")
+                self.send_response(status)
+                self.send_header("Content-Length", str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+        return Handler
+
+    def _route(self, method: str, path: str, user_id: str, body: bytes):
+        if "/directory/room/" in path:
+            return 200, {"room_id": self.room_id}
+        if path.endswith("/createRoom"):
+            return 200, {"room_id": self.room_id}
+        if "/send/m.room.message/" in path:
+            content = json.loads(body)
+            if content.get("msgtype") == "m.image":
+                with self._lock:
+                    marker = f"bench-{self._images}"
+                    self._images += 1
+                self.arrivals.record(marker)
+            else:
+                self.arrivals.record(content.get("body", "") + " " + user_id)
+            return 200, {"event_id": "$" + uuid.uuid4().hex}
+        if path.startswith("/_matrix/client/v3/join/"):
+            self.joined[user_id] = True
+            self.arrivals.record(user_id)
+            return 200, {"room_id": self.room_id}
+        if path.endswith("/leave"):
+            self.joined.pop(user_id, None)
+            self.arrivals.record(user_id)
+            return 200, {}
+        if path.endswith("/joined_members"):
+            return 200, {"joined": {user: {} for user in self.joined}}
+        if "/profile/" in path:
+            return 404, {"errcode": "M_NOT_FOUND"}
+        if path.endswith("/register"):
+            return 200, {"user_id": json.loads(body)["username"]}
+        if path.endswith("/upload"):
+            return 200, {"content_uri": self.add_media(body)}
+        if "/download/" in path:
+            data = self.media.get(path.rsplit("/", 1)[-1])
+            if data is None:
+                return 404, {"errcode": "M_NOT_FOUND"}
+            return 200, data
+        if "/state/" in path:
+            return 200, {"event_id": "$" + uuid.uuid4().hex}
+        return 404, {"errcode": "M_UNRECOGNIZED"}
+
+
+class _FakeServer(Murmur.Server):
+    def __init__(self, murmur: "FakeMurmur"):
+        self._murmur = murmur
+
+    def addCallback(self, cb, current=None):
+        self._murmur.callbacks.append(
+            Murmur.ServerCallbackPrx.uncheckedCast(cb.ice_oneway())
+        )
+
+    def removeCallback(self, cb, current=None):
+        pass
+
+    def getChannels(self, current=None):
+        return {
+            id: Murmur.Channel(id=id, name=name, parent=0, links=[])
+            for id, name in self._murmur.channels.items()
+        }
+
+    def getUsers(self, current=None):
+        return {
+            session: Murmur.User(session=session, name=name, channel=0)
+            for session, name in enumerate(self._murmur.online)
+        }
+
+    def sendMessageChannel(self, channel, tree, text, current=None):
+        self._murmur.messages += 1
+        self._murmur.arrivals.record(text)
+
+
+class _FakeMeta(Murmur.Meta):
+    def __init__(self, server_prx):
+        self._server_prx = server_prx
+
+    def getServer(self, id, current=None):
+        return self._server_prx
+
+
+class FakeMurmur:
+    def __init__(self, channels: int = 1):
+        self.channels = {id: f"channel{id}" for id in range(channels)}
+        self.online: List[str] = []
+        self.arrivals = Arrivals()
+        self.messages = 0
+        self.callbacks: List = []
+
+        props = Ice.createProperties([])
+        props.setProperty("Ice.Default.EncodingVersion", "1.0")
+        props.setProperty("Ice.MessageSizeMax", "65536")
+        props.setProperty("Ice.ThreadPool.Server.SizeMax", "8")
+        init_data = Ice.InitializationData()
+        init_data.properties = props
+        self._comm = Ice.initialize(init_data)
+        self._adapter = self._comm.createObjectAdapterWithEndpoints(
+            "FakeMurmur", "tcp -h 127.0.0.1"
+        )
+        server_prx = Murmur.ServerPrx.uncheckedCast(
+            self._adapter.addWithUUID(_FakeServer(self))
+        )
+        self._adapter.add(_FakeMeta(server_prx), Ice.stringToIdentity("Meta"))
+        self._adapter.activate()
+        endpoint = self._adapter.getEndpoints()[0].getInfo()
+        self.port = endpoint.port
+
+    def wait_for_callback(self, timeout: float = 10.0) -> bool:
+        deadline = time.monotonic() + timeout
+        while not self.callbacks and time.monotonic() < deadline:
+            time.sleep(0.01)
+        return bool(self.callbacks)
+
+    def user(self, name: str, session: int = 1):
+        return Murmur.User(session=session, name=name, channel=0)
+
+    def fire_text(self, name: str, text: str, channel: int = 0):
+        msg = Murmur.TextMessage(sessions=[], channels=[channel], trees=[], text=text)
+        for cb in self.callbacks:
+            cb.userTextMessage(self.user(name), msg)
+
+    def fire_connected(self, name: str, session: int = 1):
+        for cb in self.callbacks:
+            cb.userConnected(self.user(name, session))
+
+    def fire_disconnected(self, name: str, session: int = 1):
+        for cb in self.callbacks:
+            cb.userDisconnected(self.user(name, session))
+
+
+def wait_for_port(address: str, timeout: float = 10.0) -> bool:
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            requests.get(address + "/metrics", timeout=1)
+            return True
+        except requests.exceptions.RequestException:
+            time.sleep(0.05)
+    return False
+
+
+def find_free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
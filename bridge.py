@@ -1,14 +1,23 @@
-import base64
 import logging
+import threading
 import uuid
-from typing import Callable, List, Tuple
-
-import requests
+from functools import partial
+from typing import Dict, FrozenSet, List, Optional, Set
 
+from coalescer import MessageCoalescer
+from htmlconvert import convert_html
+from imagecache import content_hash
+from imagepipeline import ImagePipeline
+from journal import Entry, Journal
 from matrix.appservice import Appservice
-from msghandlers import MsgHandlers
+from msghandlers import Handler, build_handler_chains
 from murmur.murmur import MurmurICE
-from utils import ensure_image_size
+from presence import PresenceDebouncer
+from registry import PuppetRegistry, UploadIndex
+from storage import Storage
+import tracing
+from utils import extract_data_images
+from workqueue import KeyedWorkQueue
 
 # This class connects the two interfaces and does the actual bridging.
 # It provides the interfaces with callback functions and transforms
@@ -20,46 +29,257 @@ class Bridge:
     def __init__(
         self,
         matrix: Appservice,
-        bridge_room: str,
+        bridge_rooms: List[str],
         user_prefix: str,
         murmur: MurmurICE,
-        msg_handlers: List[Callable[[str, str], Tuple[bool, str]]],
+        msg_handlers: Dict[str, Handler],
         message_on_connected: bool = False,
+        send_queue: Optional[KeyedWorkQueue] = None,
+        registry: Optional[PuppetRegistry] = None,
+        image_pipeline: Optional[ImagePipeline] = None,
+        uploads: Optional[UploadIndex] = None,
+        presence: Optional[PresenceDebouncer] = None,
+        max_message_length: int = 4000,
+        max_message_chunks: int = 10,
+        journal: Optional[Journal] = None,
+        coalescer: Optional[MessageCoalescer] = None,
+        journal_retry_interval: float = 60.0,
     ):
         self._matrix = matrix
-        self._bridge_room = bridge_room
-        self._bridge_room_id = None
+        # Aliases of the bridged rooms and the resolved room ids.
+        self._bridge_rooms = bridge_rooms
+        self._bridge_room_ids: Dict[str, str] = {}
+        self._bridge_room_aliases: Dict[str, str] = {}
         self._user_prefix = user_prefix
-        # Saves matrix users that already exist.
-        self._matrix_registrated_users = []
+        # Saves matrix users that already exist and the rooms they joined.
+        self._registry = (
+            registry if registry is not None else PuppetRegistry(Storage(":memory:"))
+        )
+        # Saves media that was already uploaded to matrix.
+        self._uploads = (
+            uploads if uploads is not None else UploadIndex(Storage(":memory:"))
+        )
 
         self._murmur = murmur
 
-        self._enabled_msg_handlers = msg_handlers
+        # The enabled handlers are resolved once into a chain per direction.
+        self._msg_handlers = build_handler_chains(msg_handlers)
 
         self._matrix.on_img_cb = self._on_matrix_img
         self._matrix.on_msg_cb = self._on_matrix_msg
 
         self._murmur.on_connection_cb = self._on_murmur_connection
         self._murmur.on_msg_cb = self._on_murmur_msg
+        # Events which murmur sent while the connection was down are lost.
+        self._murmur.on_reconnect_cb = self.reconcile
 
         self._message_on_connected = message_on_connected
+        # Longer murmur messages are split into chunks of this length.
+        self._max_message_length = max_message_length
+        self._max_message_chunks = max_message_chunks
 
-        self._msg_handlers = MsgHandlers()
+        # Murmur events are handed over to this queue, so the ice callback
+        # threads never wait for the matrix server.
+        self._send_queue = send_queue if send_queue is not None else KeyedWorkQueue()
+
+        self._image_pipeline = (
+            image_pipeline
+            if image_pipeline is not None
+            else ImagePipeline(self._matrix.download_media)
+        )
+
+        # Messages are recorded here until they are delivered, if enabled.
+        # Failed deliveries are retried in this interval.
+        self._journal = journal
+        self._journal_retry_interval = journal_retry_interval
+        self._journal_retry_stop = threading.Event()
+        self._journal_retry_thread: Optional[threading.Thread] = None
+
+        # Connect and disconnect events are debounced before they are sent.
+        self._presence = presence if presence is not None else PresenceDebouncer()
+        self._presence.on_change_cb = self._on_presence_change
+
+        # Matrix messages to the same room can be merged before they are sent.
+        self._coalescer = coalescer if coalescer is not None else MessageCoalescer()
+        self._coalescer.on_flush_cb = self._on_coalesced_matrix_msg
 
         self.no_resize = False
 
     def initialize(self) -> bool:
-        if not self._matrix_ensure_bridge_room():
+        for alias in self._bridge_rooms:
+            if not self._matrix_ensure_bridge_room(alias):
+                return False
+        self._send_queue.start()
+        self._presence.start()
+        self._coalescer.start()
+        if self._journal is not None and self._journal_retry_interval > 0:
+            self._journal_retry_thread = threading.Thread(
+                target=self._retry_journal, name="journal-retry", daemon=True
+            )
+            self._journal_retry_thread.start()
+
+        return True
+
+    def cleanup(self):
+        self._journal_retry_stop.set()
+        if self._journal_retry_thread is not None:
+            self._journal_retry_thread.join()
+        self._coalescer.stop()
+        self._presence.stop()
+        self._send_queue.stop()
+        self._image_pipeline.shutdown()
+        if self._journal is not None:
+            self._journal.close()
+
+    @property
+    def send_queue(self) -> KeyedWorkQueue:
+        return self._send_queue
+
+    @property
+    def image_pipeline(self) -> ImagePipeline:
+        return self._image_pipeline
+
+    @property
+    def presence(self) -> PresenceDebouncer:
+        return self._presence
+
+    @property
+    def coalescer(self) -> MessageCoalescer:
+        return self._coalescer
+
+    @property
+    def journal(self) -> Optional[Journal]:
+        return self._journal
+
+    def backlog(self) -> Dict[str, int]:
+        # Matrix messages which were accepted but not sent yet, for admission
+        # control. The send queue only carries work towards matrix.
+        return {
+            "queued": self._coalescer.pending,
+            "images": self._image_pipeline.in_flight,
+        }
+
+    def replay_journal(self) -> bool:
+        # Sends the messages which were not delivered before the last stop.
+        if self._journal is None:
+            return True
+        pending = self._journal.pending()
+        self._replay(pending)
+        if pending:
+            logging.info("replayed %d journal entries", len(pending))
+        return True
+
+    def _retry_journal(self):
+        while not self._journal_retry_stop.wait(self._journal_retry_interval):
+            failed = self._journal.take_failed()
+            if failed:
+                logging.info("retrying %d journal entries", len(failed))
+                self._replay(failed)
+
+    def _replay(self, entries: List[Entry]):
+        for id, kind, data in entries:
+            if kind == "murmur_msg":
+                queued = self._send_queue.submit(
+                    data["sender"],
+                    partial(
+                        self._bridge_murmur_msg,
+                        data["room"],
+                        data["sender"],
+                        data["msg"],
+                        id,
+                    ),
+                )
+                if not queued:
+                    self._journal_fail(id)
+            elif kind == "matrix_msg":
+                self._coalescer.submit(data["room"], data["msg"], id)
+            else:
+                logging.warning("dropping journal entry of unknown kind %s", kind)
+                self._journal.complete(id)
+
+    def _journal_add(self, kind: str, data: dict, wait: bool = True) -> str:
+        if self._journal is None:
+            return uuid.uuid4().hex
+        with tracing.span("journal"):
+            return self._journal.append(kind, data, wait)
+
+    def _journal_wait(self, id: str):
+        if self._journal is not None:
+            with tracing.span("journal_sync"):
+                self._journal.wait_synced(id)
+
+    def _journal_complete(self, id: str):
+        if self._journal is not None:
+            self._journal.complete(id)
+
+    def _journal_fail(self, id: str):
+        if self._journal is not None:
+            self._journal.fail(id)
+
+    def reconcile(self) -> bool:
+        # Brings the puppet memberships in line with the users who are online
+        # in murmur, e.g. after the bridge or its connection to murmur was
+        # down and missed disconnects.
+        # Only the differences are applied, as jobs of the send queue so they
+        # stay in order with the live events of the same user.
+        online = self._murmur.online_users()
+        if online is None:
+            logging.error("could not reconcile, murmur users unknown")
             return False
+        for alias, room_id in self._bridge_room_ids.items():
+            members = self._matrix.room_joined_members(room_id)
+            if members is None:
+                logging.error("could not reconcile room %s, members unknown", alias)
+                continue
+            joined = self._puppet_names(members)
+            for name in self._registry.joined(room_id) - joined:
+                self._registry.set_joined(name, room_id, False)
+            for name in joined:
+                self._registry.add(name)
+                self._registry.set_joined(name, room_id, True)
 
+            users = online.get(alias, set())
+            to_join = users - joined
+            to_leave = joined - users
+            dropped = 0
+            for name in to_join:
+                dropped += not self._send_queue.submit(
+                    name, partial(self._matrix_ensure_user, name, room_id)
+                )
+            for name in to_leave:
+                dropped += not self._send_queue.submit(
+                    name, partial(self._matrix_user_leave_bridge_room, name, room_id)
+                )
+            if dropped:
+                logging.warning(
+                    "could not queue %d joins and leaves of room %s, they are "
+                    "left to the next reconciliation",
+                    dropped,
+                    alias,
+                )
+            logging.info(
+                "reconciled room %s: %d online, %d joined, %d to join, %d to leave",
+                alias,
+                len(users),
+                len(joined),
+                len(to_join),
+                len(to_leave),
+            )
         return True
 
-    def _matrix_ensure_bridge_room(self) -> bool:
-        id = self._matrix.resolve_room_alias(self._bridge_room)
+    def _puppet_names(self, user_ids: List[str]) -> Set[str]:
+        names = set()
+        for user_id in user_ids:
+            localpart = user_id.split(":")[0][1:]
+            if localpart.startswith(self._user_prefix):
+                names.add(localpart[len(self._user_prefix) :])
+        return names
+
+    def _matrix_ensure_bridge_room(self, alias: str) -> bool:
+        id = self._matrix.resolve_room_alias(alias)
         if id is None:
-            logging.info("could not find matrix bridge room, creating")
-            id = self._matrix.create_room(self._bridge_room, "MandM-bridge")
+            logging.info("could not find matrix bridge room %s, creating", alias)
+            id = self._matrix.create_room(alias, "MandM-bridge")
             if id is None:
                 logging.critical("could not create bridge room")
                 return False
@@ -67,106 +287,211 @@ class Bridge:
                 logging.critical("could set default powerlevel for bridge room")
                 return False
         else:
-            logging.info("found bridge room %s", id)
-        self._bridge_room_id = id
+            logging.info("found bridge room %s: %s", alias, id)
+        self._bridge_room_ids[alias] = id
+        self._bridge_room_aliases[id] = alias
         return True
 
-    def _matrix_ensure_user(self, name: str, has_to_be_joined: bool = False) -> bool:
-        exists = self._matrix.user_exist(self._user_prefix + name)
-        if not exists:
-            logging.info("user %s does not exist, registering", name)
-            if not self._matrix.register_user(self._user_prefix + name):
-                logging.error("could not create user")
-                return False
-        if has_to_be_joined:
-            return self._matrix_user_join_bridge_room(name)
+    def _matrix_ensure_user(self, name: str, joined_room: Optional[str] = None) -> bool:
+        if not self._registry.is_registered(name):
+            exists = self._matrix.user_exist(self._user_prefix + name)
+            if not exists:
+                logging.info("user %s does not exist, registering", name)
+                if not self._matrix.register_user(self._user_prefix + name):
+                    logging.error("could not create user")
+                    return False
+            self._registry.add(name)
+        if joined_room is not None:
+            return self._matrix_user_join_bridge_room(name, joined_room)
         return True
 
-    def _matrix_user_join_bridge_room(self, name: str) -> bool:
+    def _matrix_user_join_bridge_room(self, name: str, room_id: str) -> bool:
+        if self._registry.is_joined(name, room_id):
+            return True
         joined = self._matrix.user_join_room(
-            self._user_prefix + name, self._bridge_room_id, "connected"
+            self._user_prefix + name, room_id, "connected"
         )
         if not joined:
             logging.error("user could not join the bridge room")
             return False
+        self._registry.set_joined(name, room_id, True)
         return True
 
-    def _matrix_user_leave_bridge_room(self, name: str) -> bool:
-        joined = self._matrix.user_leave_room(
-            self._user_prefix + name, self._bridge_room_id, "disconnected"
+    def _matrix_user_leave_bridge_room(self, name: str, room_id: str) -> bool:
+        if not self._registry.is_joined(name, room_id):
+            return True
+        left = self._matrix.user_leave_room(
+            self._user_prefix + name, room_id, "disconnected"
         )
-        if not joined:
-            logging.error("user could not join the bridge room")
+        if not left:
+            logging.error("user could not leave the bridge room")
             return False
+        self._registry.set_joined(name, room_id, False)
         return True
 
-    def _on_matrix_img(self, _, sender: str, image_url: str, image_name: str):
-        try:
-            img = requests.get(image_url).content
-        except requests.exceptions.RequestException:
-            logging.exception("error while getting media")
+    def _on_matrix_img(
+        self, room_id: str, sender: str, image_url: str, image_name: str
+    ):
+        alias = self._bridge_room_aliases.get(room_id)
+        if alias is None:
             return
-
         extension = "png" if ".png" in image_name else "jpeg"
-        if not self.no_resize:
-            img = ensure_image_size(img, extension)
-        else:
-            self.no_resize = False
-        encoded = base64.b64encode(img).decode("utf-8")
-        self._murmur.send_msg(
-            f'{sender} [matrix]: <img src="data:image/{extension};base64,{encoded}">'
-        )
+        resize = not self.no_resize
+        self.no_resize = False
 
-    def _on_matrix_msg(self, _, sender: str, msg: str):
-        for handler in self._enabled_msg_handlers:
-            if not handler.startswith("matrix"):
-                continue
-            send, msg = getattr(self._msg_handlers, handler)(sender, msg)
-            if not send:
-                return
+        def send(data_uri: str):
+            self._murmur.send_msg(alias, f'{sender} [matrix]: <img src="{data_uri}">')
+
+        # Messages to the room which wait to be merged are sent first.
+        self._coalescer.flush(alias)
+        media_id = image_url.rsplit("/", 1)[-1]
+        self._image_pipeline.submit(media_id, image_url, extension, resize, send)
+
+    def _on_matrix_msg(self, room_id: str, sender: str, msg: str):
+        alias = self._bridge_room_aliases.get(room_id)
+        if alias is None:
+            return
+        send, msg = self._msg_handlers["matrix"](sender, msg)
+        if not send:
+            return
         if msg == "!noresize":
             self.no_resize = True
 
-        self._murmur.send_msg(f"{sender} [matrix]: {msg}")
+        msg = f"{sender} [matrix]: {msg}"
+        entry = self._journal_add("matrix_msg", {"room": alias, "msg": msg})
+        self._coalescer.submit(alias, msg, entry)
 
-    def _on_murmur_connection(self, sender: str, connection_event: str):
-        if sender not in self._matrix_registrated_users:
-            if not self._matrix_ensure_user(sender):
-                return
-            self._matrix_registrated_users.append(sender)
-
-        if connection_event == "connected":
-            self._matrix_user_join_bridge_room(sender)
-            if self._message_on_connected:
-                sent = self._matrix.user_send_msg(
-                    self._user_prefix + sender,
-                    "connected!",
-                    self._bridge_room_id,
-                    str(uuid.uuid4()),
-                )
-                if not sent:
-                    logging.error("could not send matrix message")
+    def _on_coalesced_matrix_msg(self, alias: str, msg: str, entries: List[str]):
+        if self._murmur.send_msg(alias, msg):
+            for entry in entries:
+                self._journal_complete(entry)
         else:
-            self._matrix_user_leave_bridge_room(sender)
+            for entry in entries:
+                self._journal_fail(entry)
+
+    def _on_murmur_connection(
+        self, rooms: FrozenSet[str], sender: str, connection_event: str
+    ):
+        self._presence.submit(rooms, sender, connection_event)
+
+    def _on_presence_change(
+        self, rooms: FrozenSet[str], sender: str, connection_event: str
+    ):
+        self._send_queue.submit(
+            sender,
+            partial(self._bridge_murmur_connection, rooms, sender, connection_event),
+        )
 
-    def _on_murmur_msg(self, sender: str, msg: str):
-        for handler in self._enabled_msg_handlers:
-            if not handler.startswith("murmur"):
+    def _bridge_murmur_connection(
+        self, rooms: FrozenSet[str], sender: str, connection_event: str
+    ):
+        if connection_event != "connected":
+            for alias in rooms:
+                self._matrix_user_leave_bridge_room(
+                    sender, self._bridge_room_ids[alias]
+                )
+            return
+        if not self._matrix_ensure_user(sender):
+            return
+
+        for alias in rooms:
+            room_id = self._bridge_room_ids[alias]
+            # After a disconnect and reconnect the user is still joined.
+            if self._registry.is_joined(sender, room_id):
                 continue
-            send, msg = getattr(self._msg_handlers, handler)(sender, msg)
-            if not send:
+            if self._matrix_user_join_bridge_room(sender, room_id):
+                if self._message_on_connected:
+                    sent = self._matrix.user_send_msg(
+                        self._user_prefix + sender,
+                        "connected!",
+                        room_id,
+                        str(uuid.uuid4()),
+                    )
+                    if not sent:
+                        logging.error("could not send matrix message")
+
+    def _on_murmur_msg(self, room: str, sender: str, msg: str):
+        send, msg = self._msg_handlers["murmur"](sender, msg)
+        if not send:
+            return
+        # Not waiting for the disk here keeps the ice callback short, the
+        # send queue waits for it before the message is sent.
+        entry = self._journal_add(
+            "murmur_msg", {"room": room, "sender": sender, "msg": msg}, wait=False
+        )
+        queued = self._send_queue.submit(
+            sender, partial(self._bridge_murmur_msg, room, sender, msg, entry)
+        )
+        if not queued:
+            # Retried from the journal later, if there is one.
+            self._journal_fail(entry)
+
+    def _bridge_murmur_msg(self, room: str, sender: str, msg: str, entry: str):
+        # The matrix transaction ids are derived from the journal entry, so
+        # a replayed message replaces the parts which were already sent.
+        self._journal_wait(entry)
+        room_id = self._bridge_room_ids.get(room)
+        if room_id is None:
+            logging.warning("room %s is not bridged anymore, dropping message", room)
+            self._journal_complete(entry)
+            return
+        if not self._matrix_ensure_user(sender, joined_room=room_id):
+            self._journal_fail(entry)
+            return
+
+        msg, images = extract_data_images(msg)
+        chunks = convert_html(msg, self._max_message_length)
+        if len(chunks) > self._max_message_chunks:
+            logging.info(
+                "murmur message too big, bridging %d of %d chunks",
+                self._max_message_chunks,
+                len(chunks),
+            )
+            del chunks[self._max_message_chunks :]
+
+        # The chunks are sent one after another, so they keep their order.
+        for i, (body, formatted) in enumerate(chunks):
+            sent = self._matrix.user_send_msg(
+                self._user_prefix + sender,
+                body,
+                room_id,
+                f"{entry}.{i}",
+                formatted,
+            )
+            if not sent:
+                logging.error("could not send matrix message")
+                self._journal_fail(entry)
                 return
-        if sender not in self._matrix_registrated_users:
-            if not self._matrix_ensure_user(sender, has_to_be_joined=True):
+
+        for i, (content_type, data) in enumerate(images):
+            if not self._bridge_murmur_img(
+                room_id, sender, content_type, data, f"{entry}.img{i}"
+            ):
+                self._journal_fail(entry)
                 return
-            self._matrix_registrated_users.append(sender)
+        self._journal_complete(entry)
 
-        if len(msg) > 1000:
-            logging.info("murmur message too big, wont bridge")
-            return
+    def _bridge_murmur_img(
+        self, room_id: str, sender: str, content_type: str, data: bytes, txn: str
+    ) -> bool:
+        filename = "image." + content_type.split("/")[-1]
+        digest = content_hash(data)
+        mxc_url = self._uploads.get(digest)
+        if mxc_url is None:
+            mxc_url = self._matrix.upload_media(data, content_type, filename)
+            if mxc_url is None:
+                logging.error("could not upload murmur image")
+                return False
+            self._uploads.add(digest, mxc_url)
 
-        sent = self._matrix.user_send_msg(
-            self._user_prefix + sender, msg, self._bridge_room_id, str(uuid.uuid4())
+        sent = self._matrix.user_send_image(
+            self._user_prefix + sender,
+            mxc_url,
+            filename,
+            {"mimetype": content_type, "size": len(data)},
+            room_id,
+            txn,
         )
         if not sent:
-            logging.error("could not send matrix message")
+            logging.error("could not send matrix image")
+        return sent
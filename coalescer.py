@@ -0,0 +1,188 @@
+import logging
+import threading
+import time
+from collections import OrderedDict, deque
+from typing import Callable, Deque, List, Optional, Tuple
+
+import tracing
+
+# Merges consecutive matrix messages to the same room into one murmur
+# message, so a backlog of events (e.g. after the matrix server was down)
+# does not become one ice call per message and channel. The first message
+# of a room opens a window, further messages within the window are appended
+# as new lines, in order and each with its sender. When the window has
+# passed, or the next message would make the merged one longer than the
+# maximum, the merged message is sent. A window of 0 sends every message
+# right away.
+
+SEPARATOR = "<br>"
+
+
+class _Batch:
+    __slots__ = ("msgs", "entries", "length", "deadline", "traces")
+
+    def __init__(self, deadline: float):
+        self.msgs: List[str] = []
+        self.entries: List[str] = []
+        self.length = 0
+        self.deadline = deadline
+        # The traces of the merged messages, continued when it is sent.
+        self.traces: Tuple[tracing.Trace, ...] = ()
+
+    def add(self, msg: str, entry: str):
+        if self.msgs:
+            self.length += len(SEPARATOR)
+        self.msgs.append(msg)
+        self.entries.append(entry)
+        self.length += len(msg)
+
+
+class MessageCoalescer:
+    def __init__(self, window: float = 0.0, max_length: int = 5000):
+        self._window = window
+        self._max_length = max_length
+        self._on_flush_cb: Optional[Callable[[str, str, List[str]], None]] = None
+
+        # Open batches per room, ordered by their first message, which is
+        # also the order of the deadlines.
+        self._pending: "OrderedDict[str, _Batch]" = OrderedDict()
+        # Full batches, sent before any other batch.
+        self._ready: Deque[Tuple[str, _Batch]] = deque()
+        self._lock = threading.Lock()
+        self._wakeup = threading.Condition(self._lock)
+        # Held from taking batches until they are sent, so a batch taken
+        # later is never sent before an earlier one. Taken before _lock.
+        self._send_lock = threading.Lock()
+        self._thread: Optional[threading.Thread] = None
+        self._stopped = False
+
+        self._flushed = 0
+        self._merged = 0
+
+    @property
+    def on_flush_cb(self) -> Callable[[str, str, List[str]], None]:
+        return self._on_flush_cb
+
+    @on_flush_cb.setter
+    def on_flush_cb(self, cb: Callable[[str, str, List[str]], None]):
+        self._on_flush_cb = cb
+
+    @property
+    def pending(self) -> int:
+        with self._lock:
+            return sum(len(batch.msgs) for batch in self._pending.values())
+
+    @property
+    def flushed(self) -> int:
+        return self._flushed
+
+    @property
+    def merged(self) -> int:
+        return self._merged
+
+    def start(self):
+        if self._thread is not None or self._window <= 0:
+            return
+        self._thread = threading.Thread(target=self._run, name="coalescer", daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout: Optional[float] = 5.0):
+        with self._lock:
+            self._stopped = True
+            self._wakeup.notify()
+        if self._thread is not None:
+            self._thread.join(timeout)
+            self._thread = None
+        # What is left is sent right away instead of waiting for the window.
+        with self._send_lock:
+            with self._lock:
+                batches = list(self._ready) + list(self._pending.items())
+                self._ready.clear()
+                self._pending.clear()
+            self._flush(batches)
+
+    def submit(self, room: str, msg: str, entry: str):
+        if self._window > 0:
+            with self._lock:
+                if not self._stopped:
+                    self._add(room, msg, entry)
+                    return
+        batch = _Batch(0.0)
+        batch.add(msg, entry)
+        self._flush([(room, batch)])
+
+    def flush(self, room: str):
+        # Sends what is pending for the room right away, e.g. before an
+        # image to the room, which is not merged, so it does not overtake
+        # earlier messages.
+        with self._send_lock:
+            with self._lock:
+                batches = [(r, batch) for r, batch in self._ready if r == room]
+                if batches:
+                    self._ready = deque(
+                        (r, batch) for r, batch in self._ready if r != room
+                    )
+                batch = self._pending.pop(room, None)
+                if batch is not None:
+                    batches.append((room, batch))
+            self._flush(batches)
+
+    def _add(self, room: str, msg: str, entry: str):
+        batch = self._pending.get(room)
+        if batch is not None and (
+            batch.length + len(SEPARATOR) + len(msg) > self._max_length
+        ):
+            del self._pending[room]
+            self._ready.append((room, batch))
+            self._wakeup.notify()
+            batch = None
+        if batch is None:
+            batch = _Batch(time.monotonic() + self._window)
+            self._pending[room] = batch
+            self._wakeup.notify()
+        else:
+            self._merged += 1
+        batch.add(msg, entry)
+        batch.traces += tracing.capture()
+
+    def _run(self):
+        while True:
+            with self._lock:
+                while not self._stopped and not self._ready:
+                    if self._pending:
+                        timeout = next(iter(self._pending.values())).deadline
+                        timeout -= time.monotonic()
+                        if timeout <= 0:
+                            break
+                    else:
+                        timeout = None
+                    self._wakeup.wait(timeout)
+                if self._stopped:
+                    return
+            with self._send_lock:
+                with self._lock:
+                    batches = self._take_due(time.monotonic())
+                self._flush(batches)
+
+    def _take_due(self, now: float) -> List[Tuple[str, _Batch]]:
+        batches = list(self._ready)
+        self._ready.clear()
+        while self._pending:
+            room, batch = next(iter(self._pending.items()))
+            if batch.deadline > now:
+                break
+            del self._pending[room]
+            batches.append((room, batch))
+        return batches
+
+    def _flush(self, batches: List[Tuple[str, _Batch]]):
+        if not batches:
+            return
+        with self._lock:
+            self._flushed += len(batches)
+        for room, batch in batches:
+            if len(batch.msgs) > 1:
+                logging.debug("merged %d messages to %s", len(batch.msgs), room)
+            with tracing.activate(batch.traces):
+                if self._on_flush_cb is not None:
+                    self._on_flush_cb(room, SEPARATOR.join(batch.msgs), batch.entries)
@@ -0,0 +1,251 @@
+import html
+import re
+from collections import Counter
+from typing import List, Optional, Tuple
+
+# Converts the html of murmur messages into matrix messages in one pass.
+# The tokenizer only uses patterns which stop at the next "<" or ">", so
+# broken or hostile html is handled in linear time as well. Tags which
+# matrix allows in formatted_body are kept with their allowed attributes,
+# other tags are dropped but their text is kept. The plain body is built
+# alongside. Messages longer than the limit are split into chunks, at
+# whitespace where possible. Tags which are open at the end of a chunk are
+# closed there and opened again in the next chunk.
+
+ALLOWED_TAGS = frozenset(
+    (
+        "a b blockquote br code del em h1 h2 h3 h4 h5 h6 hr i li ol p pre s "
+        "strike strong sub sup table tbody td th thead tr u ul"
+    ).split()
+)
+VOID_TAGS = frozenset({"br", "hr", "img", "meta"})
+# The content of these tags is not part of the message.
+SKIPPED_TAGS = frozenset({"head", "script", "style", "title"})
+# These tags start on a new line in the plain body.
+BLOCK_TAGS = frozenset("blockquote div h1 h2 h3 h4 h5 h6 hr li p pre tr".split())
+LINK_SCHEMES = ("http://", "https://", "mailto:")
+# Tags nested deeper are dropped, every chunk has to reopen the open tags.
+MAX_DEPTH = 32
+
+TOKEN_RE = re.compile(
+    r"<!--[^<>]*-->|<![^<>]*>"
+    r"|<(/?)([a-zA-Z][a-zA-Z0-9]*)((?:[^<>\"']|\"[^\"<>]*\"|'[^'<>]*')*)>"
+)
+ATTRIBUTE_RE = re.compile(
+    r"([\w-]+)(?:\s*=\s*(?:\"([^\"]*)\"|'([^']*)'|([^\s\"'>]+)))?"
+)
+
+# A chunk of a message: the plain body and the formatted body, which is None
+# if the chunk has no formatting.
+Chunk = Tuple[str, Optional[str]]
+
+
+class _Converter:
+    def __init__(self, limit: int):
+        self._limit = max(1, limit)
+        self._chunks: List[Chunk] = []
+        self._body: List[str] = []
+        self._body_len = 0
+        self._html: List[str] = []
+        self._html_len = 0
+        self._formatted = False
+        self._line_start = True
+        # Open tags and their opening html, to reopen them in the next chunk.
+        self._open: List[Tuple[str, str]] = []
+        self._open_count: Counter = Counter()
+        self._skip = 0
+        # Targets and text of the open links, for the plain body.
+        self._links: List[Tuple[str, List[str]]] = []
+
+    def feed(self, msg: str):
+        pos = 0
+        for match in TOKEN_RE.finditer(msg):
+            if match.start() > pos:
+                self.handle_data(html.unescape(msg[pos : match.start()]))
+            pos = match.end()
+            closing, tag, attributes = match.groups()
+            if tag is None:
+                # A comment or a doctype.
+                continue
+            tag = tag.lower()
+            if closing:
+                self.handle_endtag(tag)
+                continue
+            self.handle_starttag(tag, attributes)
+            if attributes.endswith("/"):
+                self.handle_endtag(tag)
+        if pos < len(msg):
+            self.handle_data(html.unescape(msg[pos:]))
+
+    def chunks(self) -> List[Chunk]:
+        self._flush()
+        return self._chunks
+
+    def handle_starttag(self, tag: str, attributes: str):
+        if tag in SKIPPED_TAGS:
+            self._skip += 1
+            return
+        if self._skip:
+            return
+        if tag in BLOCK_TAGS:
+            self._new_line()
+        if tag == "br":
+            self._add("\n", "<br>")
+        elif tag == "hr":
+            self._add("---\n", "<hr>")
+        elif tag == "li":
+            self._add("- ", "")
+        if tag not in ALLOWED_TAGS or tag in VOID_TAGS:
+            return
+        if len(self._open) >= MAX_DEPTH:
+            return
+
+        attrs = {
+            name.lower(): html.unescape(value or "".join(rest))
+            for name, value, *rest in ATTRIBUTE_RE.findall(attributes)
+        }
+        opening = f"<{tag}>"
+        if tag == "a":
+            href = attrs.get("href") or ""
+            if not href.startswith(LINK_SCHEMES):
+                return
+            self._links.append((href, []))
+            opening = f'<a href="{html.escape(href)}">'
+        elif tag == "ol" and (attrs.get("start") or "").isdigit():
+            opening = f'<ol start="{attrs["start"]}">'
+        self._open.append((tag, opening))
+        self._open_count[tag] += 1
+        self._add("", opening)
+
+    def handle_endtag(self, tag: str):
+        if tag in SKIPPED_TAGS:
+            self._skip = max(0, self._skip - 1)
+            return
+        if self._skip:
+            return
+        if self._open_count[tag]:
+            while self._open:
+                open_tag, _ = self._open.pop()
+                self._open_count[open_tag] -= 1
+                self._add("", f"</{open_tag}>")
+                if open_tag == "a":
+                    self._close_link()
+                if open_tag == tag:
+                    break
+        if tag in BLOCK_TAGS:
+            self._new_line()
+
+    def handle_data(self, data: str):
+        if self._skip:
+            return
+        # Line breaks between the tags of a html document are no content.
+        if "\n" in data and not data.strip():
+            return
+        for _, text in self._links:
+            text.append(data)
+        self._add_text(data)
+
+    def _close_link(self):
+        href, text = self._links.pop()
+        if "".join(text).strip() != href:
+            self._add(f" ({href})", "")
+
+    def _new_line(self):
+        if not self._line_start:
+            self._add("\n", "")
+
+    def _add_text(self, text: str):
+        # Only the part which fits into the current chunk is looked at in
+        # every step, so long texts are split in linear time.
+        pos = 0
+        while pos < len(text):
+            free = self._limit - max(self._body_len, self._html_len)
+            if len(text) - pos <= free:
+                part = text[pos:] if pos else text
+                escaped = html.escape(part, quote=False)
+                if len(escaped) <= free:
+                    self._add(part, escaped)
+                    return
+            if free < self._limit // 4 and self._body_len:
+                self._flush()
+                continue
+            part = self._cut(text[pos : pos + max(1, free)], max(1, free))
+            self._add(part, html.escape(part, quote=False))
+            self._flush()
+            pos += len(part)
+
+    def _cut(self, text: str, free: int) -> str:
+        # Returns the start of the text which fits, preferably ending at
+        # whitespace.
+        cut = len(text)
+        while cut > 1:
+            length = len(html.escape(text[:cut], quote=False))
+            if length <= free:
+                break
+            # Shrinks in proportion to how much the escaping grows the text.
+            cut = max(1, min(cut - 1, cut * free // length))
+        space = max(text.rfind(" ", 0, cut), text.rfind("\n", 0, cut))
+        if space > cut // 2:
+            return text[: space + 1]
+        return text[:cut]
+
+    def _add(self, body: str, formatted: str):
+        if formatted.startswith("<"):
+            self._formatted = True
+        if body:
+            self._line_start = body.endswith("\n")
+            self._body.append(body)
+            self._body_len += len(body)
+        self._html.append(formatted)
+        self._html_len += len(formatted)
+
+    def _flush(self):
+        for tag, _ in reversed(self._open):
+            self._html.append(f"</{tag}>")
+        body = "".join(self._body).strip()
+        if body:
+            formatted = "".join(self._html).strip() if self._formatted else None
+            self._chunks.append((body, formatted))
+        self._body = []
+        self._body_len = 0
+        self._line_start = True
+        self._html = [opening for _, opening in self._open]
+        self._html_len = sum(len(opening) for opening in self._html)
+        self._formatted = bool(self._open)
+
+
+def convert_html(msg: str, limit: int = 4000) -> List[Chunk]:
+    converter = _Converter(limit)
+    converter.feed(msg)
+    return converter.chunks()
+
+
+LINK_TAG_RE = re.compile(r"<a\s[^<>]*>|</a>", re.IGNORECASE)
+HREF_RE = re.compile(r'href="([^"]*)"', re.IGNORECASE)
+
+
+def unwrap_links(msg: str) -> str:
+    # Replaces every link with its target. Each tag is found by a scan which
+    # stops at the next "<", so this stays linear on unclosed tags.
+    parts = []
+    pos = 0
+    # Start of the open link and its target.
+    link: Optional[Tuple[int, str]] = None
+    for match in LINK_TAG_RE.finditer(msg):
+        if match.group().lower() == "</a>":
+            if link is not None:
+                parts.append(link[1])
+                pos = match.end()
+                link = None
+            continue
+        href = HREF_RE.search(match.group())
+        if href is None:
+            continue
+        if link is not None:
+            # The previous link is not closed, keep it as it is.
+            pos = link[0]
+        parts.append(msg[pos : match.start()])
+        link = (match.start(), href.group(1))
+        pos = match.end()
+    parts.append(msg[link[0] if link is not None else pos :])
+    return "".join(parts)
@@ -0,0 +1,148 @@
+import hashlib
+import logging
+import os
+import threading
+from collections import OrderedDict
+from typing import Optional
+
+# Cache for images that were already resized and encoded for murmur.
+# Entries are keyed by the hash of the downloaded content plus the target
+# format and size, additionally the matrix media id is mapped to the content
+# hash, so a known media id does not even have to be downloaded again.
+#
+# The first tier is an in-memory LRU, the optional second tier stores the
+# encoded images in a directory and evicts the oldest files once the byte
+# budget is exceeded.
+
+
+def content_hash(data: bytes) -> str:
+    return hashlib.sha256(data).hexdigest()
+
+
+class ImageCache:
+    def __init__(
+        self,
+        max_entries: int = 256,
+        directory: Optional[str] = None,
+        disk_budget: int = 256 * 1024 * 1024,
+    ):
+        self._max_entries = max(1, max_entries)
+        self._directory = directory
+        self._disk_budget = disk_budget
+        self._lock = threading.Lock()
+
+        self._memory: "OrderedDict[str, str]" = OrderedDict()
+        self._media: "OrderedDict[str, str]" = OrderedDict()
+
+        self._hits = 0
+        self._misses = 0
+
+        self._disk_usage = 0
+        if self._directory is not None:
+            os.makedirs(self._directory, exist_ok=True)
+            self._disk_usage = sum(
+                entry.stat().st_size for entry in os.scandir(self._directory)
+            )
+
+    @property
+    def hits(self) -> int:
+        return self._hits
+
+    @property
+    def misses(self) -> int:
+        return self._misses
+
+    @property
+    def hit_rate(self) -> float:
+        total = self._hits + self._misses
+        return self._hits / total if total else 0.0
+
+    @staticmethod
+    def key(digest: str, format: str, size: str) -> str:
+        return f"{digest}-{format}-{size}"
+
+    def media_hash(self, media_id: str) -> Optional[str]:
+        with self._lock:
+            digest = self._media.get(media_id)
+            if digest is not None:
+                self._media.move_to_end(media_id)
+            return digest
+
+    def get(self, key: str) -> Optional[str]:
+        with self._lock:
+            encoded = self._memory.get(key)
+            if encoded is not None:
+                self._memory.move_to_end(key)
+                self._hits += 1
+                return encoded
+        encoded = self._disk_get(key)
+        with self._lock:
+            if encoded is None:
+                self._misses += 1
+                return None
+            self._hits += 1
+            self._memory_put(key, encoded)
+        return encoded
+
+    def put(self, media_id: str, digest: str, key: str, encoded: str):
+        with self._lock:
+            self._media[media_id] = digest
+            self._media.move_to_end(media_id)
+            while len(self._media) > self._max_entries * 4:
+                self._media.popitem(last=False)
+            self._memory_put(key, encoded)
+        self._disk_put(key, encoded)
+
+    def _memory_put(self, key: str, encoded: str):
+        self._memory[key] = encoded
+        self._memory.move_to_end(key)
+        while len(self._memory) > self._max_entries:
+            self._memory.popitem(last=False)
+
+    def _disk_get(self, key: str) -> Optional[str]:
+        if self._directory is None:
+            return None
+        path = os.path.join(self._directory, key)
+        try:
+            with open(path, "r", encoding="ascii") as file:
+                encoded = file.read()
+            os.utime(path)
+            return encoded
+        except OSError:
+            return None
+
+    def _disk_put(self, key: str, encoded: str):
+        if self._directory is None or len(encoded) > self._disk_budget:
+            return
+        path = os.path.join(self._directory, key)
+        if os.path.exists(path):
+            return
+        try:
+            with open(path, "w", encoding="ascii") as file:
+                file.write(encoded)
+        except OSError:
+            logging.exception("could not write image cache entry")
+            return
+        with self._lock:
+            self._disk_usage += len(encoded)
+            if self._disk_usage <= self._disk_budget:
+                return
+        self._disk_evict()
+
+    def _disk_evict(self):
+        entries = sorted(
+            (entry.stat().st_mtime, entry.stat().st_size, entry.path)
+            for entry in os.scandir(self._directory)
+        )
+        usage = sum(size for _, size, _ in entries)
+        for _, size, path in entries:
+            if usage <= self._disk_budget * 0.9:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            usage -= size
+        with self._lock:
+            self._disk_usage = usage
+        logging.debug("evicted image cache, %d bytes on disk", usage)
@@ -0,0 +1,164 @@
+import base64
+import logging
+import multiprocessing
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from typing import Callable, Optional, Tuple
+
+from imagecache import ImageCache, content_hash
+from metrics import IMAGE_SECONDS
+import tracing
+from utils import fit_image
+
+# Processes images posted in matrix outside of the appservice request thread.
+# The download happens on a small thread pool, resizing and encoding is done
+# in a process pool so it does not hold the GIL of the bridge process. The
+# pool does not fork the bridge process, whose other threads may hold locks
+# at that moment, its processes are started by a forkserver.
+# The result is a data uri, the format may differ from the requested one.
+# The traces of the submitter are continued by the download thread.
+
+# Room in a murmur message for the html around the image and the sender name.
+MESSAGE_OVERHEAD = 256
+
+
+def encode_image(
+    image: bytes, format: str, resize: bool, max_bytes: int = 0
+) -> Tuple[str, float, float]:
+    # Runs in the process pool, returns the data uri of the image and how
+    # long resizing and encoding took.
+    start = time.perf_counter()
+    image, format = fit_image(image, format, (600, 450) if resize else None, max_bytes)
+    resized = time.perf_counter()
+    encoded = base64.b64encode(image).decode("utf-8")
+    return (
+        f"data:image/{format};base64,{encoded}",
+        resized - start,
+        time.perf_counter() - resized,
+    )
+
+
+class ImagePipeline:
+    def __init__(
+        self,
+        download: Callable[[str, int, float], Optional[bytes]],
+        workers: int = 2,
+        processes: int = 2,
+        max_bytes: int = 10 * 1024 * 1024,
+        timeout: float = 30.0,
+        cache: Optional[ImageCache] = None,
+        max_message_length: int = 0,
+    ):
+        self._download = download
+        self._cache = cache
+        self._max_bytes = max_bytes
+        self._timeout = timeout
+        # Murmur rejects image messages longer than its imagemessagelength,
+        # base64 makes the image a third bigger.
+        self._max_message_length = max_message_length
+        self._max_image_bytes = (
+            max(1, (max_message_length - MESSAGE_OVERHEAD) * 3 // 4)
+            if max_message_length > 0
+            else 0
+        )
+
+        self._threads = ThreadPoolExecutor(max(1, workers), "image")
+        self._processes = ProcessPoolExecutor(
+            max(1, processes), mp_context=multiprocessing.get_context("forkserver")
+        )
+
+        self._lock = threading.Lock()
+        self._in_flight = 0
+
+    @property
+    def in_flight(self) -> int:
+        return self._in_flight
+
+    @property
+    def cache(self) -> Optional[ImageCache]:
+        return self._cache
+
+    def submit(
+        self,
+        media_id: str,
+        url: str,
+        format: str,
+        resize: bool,
+        on_done: Callable[[str], None],
+    ):
+        with self._lock:
+            self._in_flight += 1
+        traces = tracing.capture()
+        try:
+            self._threads.submit(
+                self._traced,
+                traces,
+                time.perf_counter(),
+                media_id,
+                url,
+                format,
+                resize,
+                on_done,
+            )
+        except RuntimeError:
+            # The pipeline was shut down.
+            logging.warning("dropping image %s, the bridge is stopping", url)
+            tracing.release(traces)
+            with self._lock:
+                self._in_flight -= 1
+
+    def shutdown(self):
+        self._threads.shutdown(wait=False, cancel_futures=True)
+        self._processes.shutdown(wait=False, cancel_futures=True)
+
+    def _traced(self, traces, submitted: float, *args):
+        with tracing.activate(traces):
+            tracing.record("image_queue", time.perf_counter() - submitted)
+            self._process(*args)
+
+    def _process(
+        self,
+        media_id: str,
+        url: str,
+        format: str,
+        resize: bool,
+        on_done: Callable[[str], None],
+    ):
+        size = f"{'600x450' if resize else 'full'}-{self._max_message_length}"
+        try:
+            if self._cache is not None:
+                digest = self._cache.media_hash(media_id)
+                if digest is not None:
+                    encoded = self._cache.get(ImageCache.key(digest, format, size))
+                    if encoded is not None:
+                        on_done(encoded)
+                        return
+
+            with IMAGE_SECONDS.time(step="download"):
+                img = self._download(url, self._max_bytes, self._timeout)
+            if img is None:
+                return
+
+            if self._cache is not None:
+                digest = content_hash(img)
+                key = ImageCache.key(digest, format, size)
+                encoded = self._cache.get(key)
+                if encoded is not None:
+                    self._cache.put(media_id, digest, key, encoded)
+                    on_done(encoded)
+                    return
+
+            encoded, resize_seconds, encode_seconds = self._processes.submit(
+                encode_image, img, format, resize, self._max_image_bytes
+            ).result()
+            IMAGE_SECONDS.observe(resize_seconds, step="resize")
+            IMAGE_SECONDS.observe(encode_seconds, step="encode")
+            if self._cache is not None:
+                self._cache.put(media_id, digest, key, encoded)
+            on_done(encoded)
+        except Exception:
+            logging.exception("error while processing image %s", url)
+        finally:
+            with self._lock:
+                self._in_flight -= 1
@@ -0,0 +1,235 @@
+import json
+import logging
+import os
+import threading
+import uuid
+from typing import Dict, List, Tuple
+
+# Append-only journal of the messages which are on their way to the other
+# side. An entry is added before a message is handed over and completed once
+# it was delivered, entries which are still pending at startup get replayed.
+# The entry id is used as the matrix transaction id, so a replayed message
+# is not posted twice.
+#
+# Appends are written by one writer thread: everything appended while the
+# previous batch was synced goes into the next batch, which is synced with a
+# single fsync (group commit). append blocks until its entry is on disk,
+# unless told not to, then wait_synced does that later, e.g. in the thread
+# which delivers the message. Completions are not waited for, at worst an
+# entry is replayed once more. When the file holds many completed entries it
+# is rewritten with only the pending ones.
+#
+# Failed deliveries are recorded too. The failed entries are retried, until
+# an entry failed max_attempts times, then it is marked dead: it is dropped
+# from the pending entries and logged, instead of being replayed forever.
+
+# A pending entry: id, kind and the data of the message.
+Entry = Tuple[str, str, dict]
+
+
+class Journal:
+    def __init__(
+        self, path: str, compact_threshold: int = 10000, max_attempts: int = 5
+    ):
+        self._path = path
+        self._compact_threshold = compact_threshold
+        self._max_attempts = max(1, max_attempts)
+
+        self._lock = threading.Lock()
+        self._appended = threading.Condition(self._lock)
+        self._synced = threading.Condition(self._lock)
+        self._buffer: List[bytes] = []
+        self._seq = 0
+        self._synced_seq = 0
+        self._stopped = False
+
+        self._pending: Dict[str, Tuple[str, dict]] = {}
+        # Sequence numbers of appends which were not waited for yet.
+        self._unsynced: Dict[str, int] = {}
+        # Failed deliveries per pending entry, and the entries to retry.
+        self._attempts: Dict[str, int] = {}
+        self._failed: List[str] = []
+        self._dead = 0
+        self._records = 0
+        self._load()
+        self._file = open(path, "ab")
+        self._syncs = 0
+
+        self._thread = threading.Thread(target=self._write, name="journal", daemon=True)
+        self._thread.start()
+        logging.debug("opened journal %s, %d pending", path, len(self._pending))
+
+    @property
+    def pending_count(self) -> int:
+        return len(self._pending)
+
+    @property
+    def syncs(self) -> int:
+        return self._syncs
+
+    @property
+    def dead(self) -> int:
+        return self._dead
+
+    def pending(self) -> List[Entry]:
+        with self._lock:
+            return [(id, kind, data) for id, (kind, data) in self._pending.items()]
+
+    def append(self, kind: str, data: dict, wait: bool = True) -> str:
+        id = uuid.uuid4().hex
+        line = json.dumps({"add": id, "kind": kind, "data": data}) + "\n"
+        with self._lock:
+            self._pending[id] = (kind, data)
+            self._buffer.append(line.encode("utf-8"))
+            self._seq += 1
+            self._appended.notify()
+            if wait:
+                self._wait(self._seq)
+            else:
+                self._unsynced[id] = self._seq
+        return id
+
+    def wait_synced(self, id: str):
+        # Blocks until an entry appended without waiting is on disk.
+        with self._lock:
+            seq = self._unsynced.pop(id, None)
+            if seq is not None:
+                self._wait(seq)
+
+    def complete(self, id: str):
+        with self._lock:
+            if self._pending.pop(id, None) is None:
+                return
+            self._attempts.pop(id, None)
+            self._add_record({"done": id})
+
+    def fail(self, id: str):
+        # Records a failed delivery, the entry is retried or marked dead.
+        with self._lock:
+            entry = self._pending.get(id)
+            if entry is None:
+                return
+            attempts = self._attempts.get(id, 0) + 1
+            if attempts < self._max_attempts:
+                self._attempts[id] = attempts
+                self._failed.append(id)
+                self._add_record({"fail": id})
+                return
+            del self._pending[id]
+            self._attempts.pop(id, None)
+            self._unsynced.pop(id, None)
+            self._dead += 1
+            self._add_record({"dead": id})
+        logging.error(
+            "giving up on journaled %s after %d attempts: %s",
+            entry[0],
+            attempts,
+            entry[1],
+        )
+
+    def take_failed(self) -> List[Entry]:
+        # Returns the entries which failed since the last call, to retry them.
+        with self._lock:
+            failed = [
+                (id, *self._pending[id]) for id in self._failed if id in self._pending
+            ]
+            self._failed = []
+        return failed
+
+    def _add_record(self, record: dict):
+        # Called with the lock held, the record is not waited for.
+        self._buffer.append((json.dumps(record) + "\n").encode("utf-8"))
+        self._seq += 1
+        self._appended.notify()
+
+    def _wait(self, seq: int):
+        # Called with the lock held.
+        while self._synced_seq < seq and not self._stopped:
+            self._synced.wait()
+
+    def close(self):
+        with self._lock:
+            self._stopped = True
+            self._appended.notify()
+        self._thread.join()
+        self._file.close()
+
+    def _load(self):
+        if not os.path.exists(self._path):
+            return
+        with open(self._path, "rb") as file:
+            for line in file:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # The last line may be cut off by a crash.
+                    logging.warning("skipping broken journal record")
+                    continue
+                self._records += 1
+                if "add" in record:
+                    self._pending[record["add"]] = (record["kind"], record["data"])
+                    if record.get("attempts"):
+                        self._attempts[record["add"]] = record["attempts"]
+                elif "fail" in record:
+                    id = record["fail"]
+                    self._attempts[id] = self._attempts.get(id, 0) + 1
+                else:
+                    id = record.get("done") or record.get("dead")
+                    self._pending.pop(id, None)
+                    self._attempts.pop(id, None)
+
+    def _write(self):
+        while True:
+            with self._lock:
+                while not self._buffer and not self._stopped:
+                    self._appended.wait()
+                if not self._buffer and self._stopped:
+                    return
+                batch = self._buffer
+                self._buffer = []
+                seq = self._seq
+
+            self._file.write(b"".join(batch))
+            self._file.flush()
+            os.fsync(self._file.fileno())
+
+            with self._lock:
+                self._syncs += 1
+                self._records += len(batch)
+                self._synced_seq = seq
+                self._synced.notify_all()
+                compact = (
+                    self._records > self._compact_threshold
+                    and len(self._pending) * 2 < self._records
+                )
+            if compact:
+                self._compact()
+
+    def _compact(self):
+        # Only the snapshot and the swap hold the lock, appends go on while
+        # the file is written. Records appended meanwhile stay in the buffer
+        # and are written to the new file after the swap. Records which
+        # were already in the buffer are in the snapshot too and get written
+        # again, loading the journal tolerates the duplicates.
+        with self._lock:
+            entries = [
+                (id, kind, data, self._attempts.get(id))
+                for id, (kind, data) in self._pending.items()
+            ]
+        tmp = self._path + ".tmp"
+        with open(tmp, "wb") as file:
+            for id, kind, data, attempts in entries:
+                record = {"add": id, "kind": kind, "data": data}
+                if attempts:
+                    record["attempts"] = attempts
+                file.write((json.dumps(record) + "\n").encode("utf-8"))
+            file.flush()
+            os.fsync(file.fileno())
+        with self._lock:
+            os.replace(tmp, self._path)
+            self._file.close()
+            self._file = open(self._path, "ab")
+            logging.debug(
+                "compacted journal from %d to %d records", self._records, len(entries)
+            )
+            self._records = len(entries)
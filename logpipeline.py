@@ -0,0 +1,158 @@
+import logging
+import logging.handlers
+import queue
+import sys
+import threading
+from typing import Dict, Optional
+
+# Writes log records on a background thread. The logging call only puts the
+# record into a bounded queue, formatting and writing happens in the thread
+# of a QueueListener, so slow log output does not delay the bridge. If the
+# queue is full the record is dropped.
+#
+# Debug records can be sampled per category, which is the module that logs
+# them, e.g. only every tenth debug line of the murmur callbacks is kept.
+# Message texts are logged through Body, which truncates or redacts them
+# when the record is formatted, so dropped records never pay for it.
+
+FORMAT = "%(asctime)s - %(levelname)s - %(message)s"
+
+
+class Body:
+    # Message text in a log record. The mode is set by the LogPipeline:
+    # full, truncate (to max_length characters) or redact.
+    __slots__ = ("_text",)
+
+    mode = "full"
+    max_length = 200
+
+    def __init__(self, text: str):
+        self._text = text
+
+    def __str__(self) -> str:
+        if Body.mode == "redact":
+            return f"<{len(self._text)} chars>"
+        if Body.mode == "truncate" and len(self._text) > Body.max_length:
+            return (
+                f"{self._text[:Body.max_length]}... "
+                f"<{len(self._text) - Body.max_length} more chars>"
+            )
+        return self._text
+
+
+def parse_sample_rates(value: str) -> Dict[str, float]:
+    # Parses "callbacks:0.1,appservice:0.5" into rates per category.
+    rates = {}
+    for item in value.split(","):
+        if not item.strip():
+            continue
+        category, _, rate = item.partition(":")
+        rates[category.strip()] = float(rate)
+    return rates
+
+
+class _SamplingFilter(logging.Filter):
+    def __init__(self, rates: Dict[str, float]):
+        super().__init__()
+        self._rates = rates
+        self._counts: Dict[str, int] = {}
+        self.sampled_out = 0
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno > logging.DEBUG:
+            return True
+        rate = self._rates.get(record.module)
+        if rate is None:
+            return True
+        # Keeps records evenly spread instead of at random.
+        count = self._counts.get(record.module, 0) + 1
+        self._counts[record.module] = count
+        if int(count * rate) != int((count - 1) * rate):
+            return True
+        self.sampled_out += 1
+        return False
+
+
+class _QueueHandler(logging.handlers.QueueHandler):
+    # The SimpleQueue is much cheaper to put into than a bounded Queue, the
+    # bound is checked by the handler instead.
+    def __init__(self, log_queue: queue.SimpleQueue, max_size: int):
+        super().__init__(log_queue)
+        self._max_size = max(1, max_size)
+        self.dropped = 0
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # Unlike the default, the message is formatted by the listener. The
+        # arguments of the bridge's log calls are immutable, only tracebacks
+        # are rendered right away so their frames are not kept alive.
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record: logging.LogRecord):
+        if self.queue.qsize() >= self._max_size:
+            self.dropped += 1
+            return
+        self.queue.put_nowait(record)
+
+
+class LogPipeline:
+    def __init__(
+        self,
+        level: str = "INFO",
+        sample_rates: Optional[Dict[str, float]] = None,
+        body_mode: str = "full",
+        max_body_length: int = 200,
+        queue_size: int = 10000,
+    ):
+        self._level = logging.getLevelName(level.upper())
+        if not isinstance(self._level, int):
+            raise ValueError(f"unknown log level {level}")
+        if body_mode not in ("full", "truncate", "redact"):
+            raise ValueError(f"unknown body mode {body_mode}")
+        Body.mode = body_mode
+        Body.max_length = max_body_length
+
+        self._queue: queue.SimpleQueue = queue.SimpleQueue()
+        self._handler = _QueueHandler(self._queue, queue_size)
+        self._filter = _SamplingFilter(sample_rates or {})
+        self._handler.addFilter(self._filter)
+        output = logging.StreamHandler(sys.stderr)
+        output.setFormatter(logging.Formatter(FORMAT))
+        self._listener = logging.handlers.QueueListener(self._queue, output)
+        self._lock = threading.Lock()
+        self._started = False
+
+    @property
+    def queued(self) -> int:
+        return self._queue.qsize()
+
+    @property
+    def dropped(self) -> int:
+        return self._handler.dropped
+
+    @property
+    def sampled_out(self) -> int:
+        return self._filter.sampled_out
+
+    def start(self):
+        with self._lock:
+            if self._started:
+                return
+            self._started = True
+        root = logging.getLogger()
+        for handler in root.handlers[:]:
+            root.removeHandler(handler)
+        root.addHandler(self._handler)
+        root.setLevel(self._level)
+        self._listener.start()
+
+    def stop(self):
+        # Writes the records which are still queued.
+        with self._lock:
+            if not self._started:
+                return
+            self._started = False
+        self._listener.stop()
+        logging.getLogger().removeHandler(self._handler)
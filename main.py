@@ -1,29 +1,73 @@
 import logging
 import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
 from configparser import ConfigParser
 import argparse
+from typing import Callable, Dict, Optional
 
 from matrix.appservice import Appservice
+from matrix.dedup import DedupIndex
+from matrix.ratelimit import RateLimiter
 from murmur.murmur import MurmurICE
+import murmur.slice as murmur_slice
 
+from admission import AdmissionControl
 from bridge import Bridge
-from utils import load_enabled_msg_handlers, generate_appservice_config
+from coalescer import MessageCoalescer
+from metrics import REGISTRY
+from msghandlers import available_msg_handlers
+from imagecache import ImageCache
+from imagepipeline import ImagePipeline
+from journal import Journal
+from logpipeline import LogPipeline, parse_sample_rates
+from presence import PresenceDebouncer
+from registry import PuppetRegistry, UploadIndex
+from storage import Storage
+from tracing import TRACER
+from workqueue import KeyedWorkQueue
+from utils import (
+    load_enabled_msg_handlers,
+    load_room_routes,
+    generate_appservice_config,
+)
 
 
 class MandMBridge:
-    def __init__(self, config_file: str):
+    def __init__(self, config_file: str, log_pipeline: Optional[LogPipeline] = None):
         self._config_file = config_file
+        self._log_pipeline = log_pipeline
 
         self._matrix = None
         self._murmur = None
         self._bridge = None
+        self._storage = None
 
     def setup(self):
         config = ConfigParser()
         config.read(self._config_file)
-        msg_handlers = load_enabled_msg_handlers(config)
+        # Entry points are loaded and handler classes created only here.
+        msg_handlers = load_enabled_msg_handlers(config, available_msg_handlers())
+        TRACER.configure(
+            config.get("tracing", "File", fallback=""),
+            config.getfloat("tracing", "SampleRate", fallback=0.01),
+            config.getfloat("tracing", "SlowThreshold", fallback=5.0),
+            config.getint("tracing", "MaxFileSize", fallback=10 * 1024 * 1024),
+            config.getint("tracing", "FileBackups", fallback=3),
+        )
 
-        self._matrix = Appservice(
+        self._storage = Storage(
+            config.get("bridge", "Database", fallback="mandm-bridge.db")
+        )
+        admission = AdmissionControl(
+            config.getint("appservice", "MaxBacklog", fallback=800),
+            config.getint("appservice", "ResumeBacklog", fallback=400),
+            config.getint("appservice", "MaxImagesInFlight", fallback=32),
+            config.getint("appservice", "ResumeImagesInFlight", fallback=16),
+            config.getfloat("appservice", "RetryAfter", fallback=5.0),
+        )
+
+        appservice_args = (
             config["matrix"]["Address"],
             config["matrix"]["ServerName"],
             config["appservice"]["ApplicationServicePort"],
@@ -31,17 +75,44 @@ class MandMBridge:
             config["appservice"]["ApplicationServiceToken"],
             config["appservice"]["HomeserverToken"],
             config["appservice"]["UserPrefix"],
+            DedupIndex(
+                config.getint("appservice", "DedupCapacity", fallback=10000),
+                self._storage,
+            ),
+            config.getfloat("matrix", "RequestTimeout", fallback=10.0),
+            config.getint("matrix", "MaxRetries", fallback=3),
+            RateLimiter(
+                config.getfloat("matrix", "RateLimit", fallback=20.0),
+                config.getfloat("matrix", "RateBurst", fallback=40.0),
+                config.getfloat("matrix", "PuppetRateLimit", fallback=2.0),
+                config.getfloat("matrix", "PuppetRateBurst", fallback=5.0),
+            ),
+            admission,
         )
+        if config.get("appservice", "Backend", fallback="threaded") == "asyncio":
+            # Only imported when used, it needs httpx and uvicorn.
+            from matrix.asyncservice import AsyncAppservice
+
+            self._matrix = AsyncAppservice(
+                *appservice_args,
+                config.getint("appservice", "Workers", fallback=8),
+                config.getint("appservice", "MaxConnections", fallback=20),
+            )
+        else:
+            self._matrix = Appservice(*appservice_args)
 
-        murmur_channel_filter = None
-        if "BridgedChannels" in config["murmur"]:
-            murmur_channel_filter = config["murmur"]["BridgedChannels"].split(",")
         self._murmur = MurmurICE(
             config["murmur"]["Address"],
             config["murmur"]["Port"],
-            int(config["murmur"]["ServerId"]),
             config["murmur"]["Secret"],
-            murmur_channel_filter,
+            load_room_routes(config),
+            config.getfloat("murmur", "ChannelCheckInterval", fallback=300.0),
+            config.getint("murmur", "AcmTimeout", fallback=30),
+            config.getfloat("murmur", "PingInterval", fallback=10.0),
+            config.getfloat("murmur", "ReconnectDelay", fallback=1.0),
+            config.getfloat("murmur", "ReconnectMaxDelay", fallback=60.0),
+            config.getint("murmur", "ThreadPoolSize", fallback=1),
+            config.getboolean("murmur", "SerializeCallbacks", fallback=True),
         )
 
         message_on_connection = False
@@ -49,19 +120,221 @@ class MandMBridge:
             message_on_connection = (
                 True if config["appservice"]["MessageOnConnected"] == "on" else False
             )
+        journal = None
+        if config.get("bridge", "Journal", fallback=""):
+            journal = Journal(
+                config["bridge"]["Journal"],
+                config.getint("bridge", "JournalCompactThreshold", fallback=10000),
+                config.getint("bridge", "JournalMaxAttempts", fallback=5),
+            )
+        send_queue = KeyedWorkQueue(
+            config.getint("bridge", "SendWorkers", fallback=4),
+            config.getint("bridge", "SendQueueSize", fallback=1000),
+        )
         self._bridge = Bridge(
             self._matrix,
-            config["appservice"]["Room"],
+            sorted(self._murmur.rooms),
             config["appservice"]["UserPrefix"],
             self._murmur,
             msg_handlers,  #
             message_on_connection,
+            send_queue,
+            PuppetRegistry(self._storage),
+            ImagePipeline(
+                self._matrix.download_media,
+                config.getint("images", "Workers", fallback=2),
+                config.getint("images", "Processes", fallback=2),
+                config.getint("images", "MaxDownloadSize", fallback=10 * 1024 * 1024),
+                config.getfloat("images", "DownloadTimeout", fallback=30.0),
+                ImageCache(
+                    config.getint("images", "CacheEntries", fallback=256),
+                    config.get("images", "CacheDirectory", fallback=None),
+                    config.getint(
+                        "images", "CacheDiskBudget", fallback=256 * 1024 * 1024
+                    ),
+                ),
+                config.getint("images", "MaxMessageLength", fallback=131072),
+            ),
+            UploadIndex(self._storage),
+            PresenceDebouncer(
+                config.getfloat("bridge", "PresenceWindow", fallback=2.0),
+                config.getint("bridge", "PresenceBatchSize", fallback=20),
+                config.getfloat("bridge", "PresenceBatchInterval", fallback=1.0),
+            ),
+            config.getint("bridge", "MaxMessageLength", fallback=4000),
+            config.getint("bridge", "MaxMessageChunks", fallback=10),
+            journal,
+            MessageCoalescer(
+                config.getfloat("bridge", "CoalesceWindow", fallback=0.0),
+                config.getint("bridge", "CoalesceMaxLength", fallback=5000),
+            ),
+            config.getfloat("bridge", "JournalRetryInterval", fallback=60.0),
+        )
+        admission.backlog_cb = self._bridge.backlog
+        self._register_metrics()
+
+    def _register_metrics(self):
+        send_queue = self._bridge.send_queue
+        images = self._bridge.image_pipeline
+        presence = self._bridge.presence
+        coalescer = self._bridge.coalescer
+        journal = self._bridge.journal
+        REGISTRY.gauge_fn(
+            "mandm_send_queue_depth",
+            "Murmur events waiting to be sent to matrix.",
+            lambda: send_queue.depth,
+        )
+        REGISTRY.counter_fn(
+            "mandm_send_queue_dropped_total",
+            "Murmur events dropped because the send queue was full.",
+            lambda: send_queue.dropped,
+        )
+        REGISTRY.gauge_fn(
+            "mandm_images_in_flight",
+            "Matrix images which are being processed.",
+            lambda: images.in_flight,
+        )
+        if images.cache is not None:
+            REGISTRY.counter_fn(
+                "mandm_image_cache_total",
+                "Lookups in the image cache.",
+                lambda: {("hit",): images.cache.hits, ("miss",): images.cache.misses},
+                ("result",),
+            )
+        REGISTRY.counter_fn(
+            "mandm_dedup_total",
+            "Lookups of transaction and event ids in the dedup index.",
+            lambda: {
+                ("hit",): self._matrix.dedup.hits,
+                ("miss",): self._matrix.dedup.misses,
+            },
+            ("result",),
+        )
+        REGISTRY.counter_fn(
+            "mandm_matrix_requests_total",
+            "Requests to the matrix server which were throttled, retried or dropped.",
+            lambda: {
+                ("throttled",): self._matrix.throttled,
+                ("retried",): self._matrix.retried,
+                ("dropped",): self._matrix.dropped,
+            },
+            ("result",),
+        )
+        REGISTRY.gauge_fn(
+            "mandm_presence_pending",
+            "Murmur users with debounced connect or disconnect events.",
+            lambda: presence.pending,
+        )
+        REGISTRY.counter_fn(
+            "mandm_presence_events_total",
+            "Connect and disconnect events by how the debouncer handled them.",
+            lambda: {
+                ("applied",): presence.applied,
+                ("cancelled",): presence.cancelled,
+                ("merged",): presence.merged,
+            },
+            ("result",),
         )
 
+        REGISTRY.gauge_fn(
+            "mandm_coalescer_pending",
+            "Matrix messages waiting to be merged and sent to murmur.",
+            lambda: coalescer.pending,
+        )
+        REGISTRY.counter_fn(
+            "mandm_coalescer_messages_total",
+            "Messages sent to murmur, and messages merged into a previous one.",
+            lambda: {
+                ("sent",): coalescer.flushed,
+                ("merged",): coalescer.merged,
+            },
+            ("result",),
+        )
+        if self._log_pipeline is not None:
+            log_pipeline = self._log_pipeline
+            REGISTRY.gauge_fn(
+                "mandm_log_queue_depth",
+                "Log records waiting to be written.",
+                lambda: log_pipeline.queued,
+            )
+            REGISTRY.counter_fn(
+                "mandm_log_records_discarded_total",
+                "Log records dropped because the queue was full, or sampled out.",
+                lambda: {
+                    ("dropped",): log_pipeline.dropped,
+                    ("sampled_out",): log_pipeline.sampled_out,
+                },
+                ("reason",),
+            )
+        admission = self._matrix.admission
+        REGISTRY.gauge_fn(
+            "mandm_admission_shedding",
+            "Whether pushed transactions are rejected because of the backlog.",
+            lambda: int(admission.shedding),
+        )
+        REGISTRY.counter_fn(
+            "mandm_admission_rejected_total",
+            "Pushed transactions rejected because of the backlog.",
+            lambda: admission.rejected,
+        )
+        REGISTRY.counter_fn(
+            "mandm_traces_total",
+            "Finished message traces, and those slower than the threshold.",
+            lambda: {("finished",): TRACER.finished, ("slow",): TRACER.slow},
+            ("result",),
+        )
+        REGISTRY.gauge_fn(
+            "mandm_murmur_connected",
+            "Whether the connection to the murmur ice interface is up.",
+            lambda: int(self._murmur.connected),
+        )
+        REGISTRY.counter_fn(
+            "mandm_murmur_reconnects_total",
+            "Reconnects to the murmur ice interface after the connection was lost.",
+            lambda: self._murmur.reconnects,
+        )
+
+        if journal is not None:
+            REGISTRY.gauge_fn(
+                "mandm_journal_pending",
+                "Journaled messages which were not delivered yet.",
+                lambda: journal.pending_count,
+            )
+            REGISTRY.counter_fn(
+                "mandm_journal_syncs_total",
+                "Batches of journal records synced to disk.",
+                lambda: journal.syncs,
+            )
+            REGISTRY.counter_fn(
+                "mandm_journal_dead_total",
+                "Journaled messages given up on after JournalMaxAttempts failures.",
+                lambda: journal.dead,
+            )
+
     def do_bridge(self):
-        assert self._matrix.initialize()
-        assert self._murmur.initialize()
-        assert self._bridge.initialize()
+        start = time.monotonic()
+        timings = {"slice": murmur_slice.load_seconds}
+        assert self._timed(timings, "matrix", self._matrix.initialize)
+        # Connecting to murmur and looking up the bridge room are independent,
+        # so their round trips overlap. Murmur events which arrive before the
+        # bridge is ready wait in the not yet started send queue.
+        with ThreadPoolExecutor(2, thread_name_prefix="startup") as pool:
+            murmur = pool.submit(
+                self._timed, timings, "murmur", self._murmur.initialize
+            )
+            bridge = pool.submit(
+                self._timed, timings, "bridge", self._bridge.initialize
+            )
+            assert murmur.result()
+            assert bridge.result()
+        # A failed reconciliation is not fatal, live events still get bridged.
+        self._timed(timings, "reconcile", self._bridge.reconcile)
+        self._timed(timings, "replay", self._bridge.replay_journal)
+        logging.info(
+            "started in %.3fs (%s)",
+            time.monotonic() - start,
+            ", ".join(f"{step} {seconds:.3f}s" for step, seconds in timings.items()),
+        )
 
         # The running flask server is the main loop in this program.
         # Murmur events are triggered by an underlying C++ zeroc-ice
@@ -69,15 +342,23 @@ class MandMBridge:
         # their python callbacks.
         self._matrix.serve()
 
+    @staticmethod
+    def _timed(
+        timings: Dict[str, float], step: str, initialize: Callable[[], bool]
+    ) -> bool:
+        start = time.monotonic()
+        try:
+            return initialize()
+        finally:
+            timings[step] = time.monotonic() - start
+
     def cleanup(self):
+        self._bridge.cleanup()
         self._murmur.cleanup()
+        self._storage.close()
 
 
 if __name__ == "__main__":
-    logging.basicConfig(
-        format="%(asctime)s - %(levelname)s - %(message)s", level=logging.DEBUG
-    )
-
     args_parser = argparse.ArgumentParser(description="MandM-bridge")
     args_parser.add_argument(
         "-c", "--config", help="Path to the bridge config file.", default="bridge.conf"
@@ -90,13 +371,26 @@ if __name__ == "__main__":
     )
     args = args_parser.parse_args()
 
+    log_config = ConfigParser()
+    log_config.read(args.config)
+    log_pipeline = LogPipeline(
+        log_config.get("logging", "Level", fallback="INFO"),
+        parse_sample_rates(log_config.get("logging", "Sample", fallback="")),
+        log_config.get("logging", "Bodies", fallback="full"),
+        log_config.getint("logging", "MaxBodyLength", fallback=200),
+        log_config.getint("logging", "QueueSize", fallback=10000),
+    )
+    log_pipeline.start()
+
     if args.gen_appservice_config:
         with open("appservice_config.yaml", "w", encoding="utf-8") as file:
             file.write(generate_appservice_config(args.config))
         logging.info("wrote appservice config to appservice_config.yaml")
+        log_pipeline.stop()
         sys.exit(0)
 
-    mmb = MandMBridge(args.config)
+    mmb = MandMBridge(args.config, log_pipeline)
     mmb.setup()
     mmb.do_bridge()
     mmb.cleanup()
+    log_pipeline.stop()
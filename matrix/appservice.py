@@ -1,9 +1,22 @@
 import logging
 
 from waitress import serve
-from typing import Callable, Optional
+from typing import Any, Callable, List, Optional, Tuple, Union
+from .dedup import DedupIndex
 from .matrix import Matrix
-from flask import Flask, jsonify, request
+from .ratelimit import RateLimiter
+from flask import Flask, Response, jsonify, request
+
+import tracing
+from admission import AdmissionControl
+from logpipeline import Body
+from metrics import EVENTS, REGISTRY, TRANSACTION_SECONDS
+
+# Endpoints return a status code and a json body or plain text. They are
+# independent of the web framework, so the same endpoints can be served
+# by flask or by the asgi app of the async appservice.
+EndpointResult = Tuple[int, Union[dict, str]]
+Endpoint = Callable[..., EndpointResult]
 
 
 # This class starts an API server which represents an appservice for matrix.
@@ -24,8 +37,15 @@ class Appservice(Matrix):
         as_token: str,
         hs_token: str,
         user_prefix: str,
+        dedup: Optional[DedupIndex] = None,
+        timeout: float = 10.0,
+        max_retries: int = 3,
+        rate_limiter: Optional[RateLimiter] = None,
+        admission: Optional[AdmissionControl] = None,
     ):
-        super().__init__(matrix_server, matrix_domain, as_token)
+        super().__init__(
+            matrix_server, matrix_domain, as_token, timeout, max_retries, rate_limiter
+        )
         self._matrix_domain = matrix_domain
 
         # TODO: use this somehow
@@ -40,7 +60,17 @@ class Appservice(Matrix):
         self._on_msg_cb = None
         self._on_img_cb = None
 
-        self._media_api = f"{matrix_server}/_matrix/media/v3"
+        self._dedup = dedup if dedup is not None else DedupIndex()
+        # Decides if pushed transactions are processed or retried later.
+        self._admission = admission if admission is not None else AdmissionControl(0)
+
+    @property
+    def dedup(self) -> DedupIndex:
+        return self._dedup
+
+    @property
+    def admission(self) -> AdmissionControl:
+        return self._admission
 
     @property
     def on_msg_cb(self):
@@ -63,33 +93,127 @@ class Appservice(Matrix):
             self._app = app
         else:
             self._app = Flask(__name__)
-        self._app.add_url_rule(
-            "/_matrix/app/v1/transactions/<transaction>",
-            view_func=self._on_transaction_push,
-            methods=["PUT"],
-        )
-        self._app.add_url_rule("/_matrix/app/v1/rooms/<alias>", view_func=self._on_room_alias_query)
+        for method, rule, endpoint in self._endpoints():
+            self._app.add_url_rule(
+                rule,
+                endpoint=endpoint.__name__,
+                view_func=self._flask_view(endpoint),
+                methods=[method],
+            )
         return True
 
     def serve(self):
         serve(self._app, host=self._ip, port=self._port)
         logging.info("past serve")
 
-    def _on_transaction_push(self, transaction):
-        events = request.get_json()["events"]
+    def _endpoints(self) -> List[Tuple[str, str, Endpoint]]:
+        return [
+            (
+                "PUT",
+                "/_matrix/app/v1/transactions/<transaction>",
+                self._on_transaction_push,
+            ),
+            ("GET", "/_matrix/app/v1/rooms/<alias>", self._on_room_alias_query),
+            ("GET", "/metrics", self._on_metrics),
+            ("GET", "/health", self._on_health),
+            ("GET", "/ready", self._on_ready),
+        ]
+
+    @staticmethod
+    def _flask_view(endpoint: Endpoint) -> Callable:
+        def view(**params):
+            status, result = endpoint(request.get_json(silent=True), **params)
+            if isinstance(result, str):
+                return Response(result, status, mimetype="text/plain")
+            return jsonify(result), status
+
+        return view
+
+    def _on_transaction_push(self, body: Any, transaction: str) -> EndpointResult:
+        with TRANSACTION_SECONDS.time():
+            return self._process_transaction(body, transaction)
+
+    def _process_transaction(self, body: Any, transaction: str) -> EndpointResult:
+        txn_key = "txn:" + transaction
+        if self._dedup.seen(txn_key):
+            logging.debug("transaction %s was already processed", transaction)
+            return 200, {}
+        if not self._dedup.claim(txn_key):
+            # A retry while the first attempt is still running, the matrix
+            # server retries it again and then gets the result.
+            logging.debug("transaction %s is being processed", transaction)
+            return 503, {
+                "errcode": "M_UNKNOWN",
+                "error": "The transaction is being processed",
+            }
+        if not self._admission.admit():
+            self._dedup.release(txn_key)
+            # The matrix server retries the transaction later.
+            return 429, {
+                "errcode": "M_LIMIT_EXCEEDED",
+                "error": "The bridge is overloaded",
+                "retry_after_ms": int(self._admission.retry_after * 1000),
+            }
+        try:
+            self._process_events(body["events"], transaction)
+        except Exception:
+            self._dedup.release(txn_key)
+            raise
+        finally:
+            self._admission.done()
+        self._dedup.add(txn_key)
+        return 200, {}
+
+    def _process_events(self, events: list, transaction: str):
         for event in events:
-            self._handle_event(event)
-        return jsonify({})
-
-    def _on_room_alias_query(self, _):
-        return jsonify({})
+            event_key = "event:" + event["event_id"] if "event_id" in event else None
+            if event_key is not None and (
+                self._dedup.seen(event_key) or not self._dedup.claim(event_key)
+            ):
+                continue
+            # Every event is traced on its own, from here on to murmur.
+            try:
+                with tracing.trace("matrix_event", transaction=transaction):
+                    self._handle_event(event)
+            except Exception:
+                if event_key is not None:
+                    self._dedup.release(event_key)
+                raise
+            # Recorded right away, so a retry after a failure does not bridge
+            # the events handled so far again.
+            if event_key is not None:
+                self._dedup.add(event_key)
+
+    def _on_room_alias_query(self, _, alias: str) -> EndpointResult:
+        return 200, {}
+
+    def _on_metrics(self, _) -> EndpointResult:
+        return 200, REGISTRY.render()
+
+    def _on_health(self, _) -> EndpointResult:
+        return 200, self._health()
+
+    def _on_ready(self, _) -> EndpointResult:
+        # Not ready while transactions are rejected.
+        health = self._health()
+        return (503 if health["shedding"] else 200), health
+
+    def _health(self) -> dict:
+        return {
+            "backlog": self._admission.check(),
+            "shedding": self._admission.shedding,
+            "rejected": self._admission.rejected,
+        }
 
     def _on_msg(self, room_id: str, sender: str, text: str):
-        logging.debug("got a message in room %s from %s: %s", room_id, sender, text)
+        logging.debug(
+            "got a message in room %s from %s: %s", room_id, sender, Body(text)
+        )
 
         if self._on_msg_cb is None:
             return
 
+        EVENTS.inc(direction="matrix_to_murmur", type="text")
         self._on_msg_cb(room_id, sender, text)
 
     def _on_img(self, room_id: str, sender: str, mxc_url: str, image_name: str):
@@ -98,6 +222,7 @@ class Appservice(Matrix):
         if self._on_img_cb is None:
             return
 
+        EVENTS.inc(direction="matrix_to_murmur", type="image")
         media_id = mxc_url.split("/")[-1]
         image_url = f"{self._media_api}/download/{self._matrix_domain}/{media_id}"
         self._on_img_cb(room_id, sender, image_url, image_name)
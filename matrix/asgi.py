@@ -0,0 +1,89 @@
+import asyncio
+import json
+import logging
+import re
+from concurrent.futures import Executor
+from functools import partial
+from typing import Callable, List, Tuple
+
+# Minimal asgi application which serves the framework independent endpoints
+# of the appservice. The endpoints are blocking (they call into the bridge),
+# so they are run on the given executor and never on the event loop.
+
+
+class AsgiApp:
+    def __init__(self, endpoints: List[Tuple[str, str, Callable]], executor: Executor):
+        self._routes = [
+            (
+                method,
+                re.compile("^" + re.sub(r"<(\w+)>", r"(?P<\1>[^/]+)", rule) + "$"),
+                endpoint,
+            )
+            for method, rule, endpoint in endpoints
+        ]
+        self._executor = executor
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return
+
+        endpoint = None
+        params = {}
+        allowed = False
+        for method, pattern, route_endpoint in self._routes:
+            match = pattern.match(scope["path"])
+            if match is None:
+                continue
+            allowed = True
+            if method == scope["method"]:
+                endpoint = route_endpoint
+                params = match.groupdict()
+                break
+        if endpoint is None:
+            await self._respond(
+                send, 405 if allowed else 404, {"errcode": "M_UNRECOGNIZED"}
+            )
+            return
+
+        raw = bytearray()
+        more_body = True
+        while more_body:
+            message = await receive()
+            raw += message.get("body", b"")
+            more_body = message.get("more_body", False)
+        try:
+            body = json.loads(raw) if raw else None
+        except ValueError:
+            await self._respond(send, 400, {"errcode": "M_NOT_JSON"})
+            return
+
+        loop = asyncio.get_running_loop()
+        try:
+            status, result = await loop.run_in_executor(
+                self._executor, partial(endpoint, body, **params)
+            )
+        except Exception:
+            logging.exception("error while handling %s", scope["path"])
+            await self._respond(send, 500, {"errcode": "M_UNKNOWN"})
+            return
+        await self._respond(send, status, result)
+
+    @staticmethod
+    async def _respond(send, status: int, result):
+        if isinstance(result, str):
+            content_type = b"text/plain; charset=utf-8"
+            payload = result.encode("utf-8")
+        else:
+            content_type = b"application/json"
+            payload = json.dumps(result).encode("utf-8")
+        await send(
+            {
+                "type": "http.response.start",
+                "status": status,
+                "headers": [
+                    (b"content-type", content_type),
+                    (b"content-length", str(len(payload)).encode("ascii")),
+                ],
+            }
+        )
+        await send({"type": "http.response.body", "body": payload})
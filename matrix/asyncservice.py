@@ -0,0 +1,180 @@
+import asyncio
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import TimeoutError as FutureTimeoutError
+from typing import Optional
+
+import httpx
+import uvicorn
+
+from admission import AdmissionControl
+
+from .appservice import Appservice
+from .asgi import AsgiApp
+from .dedup import DedupIndex
+from .ratelimit import RateLimiter
+
+# Appservice which runs on an asyncio event loop instead of waitress threads.
+#
+# The endpoints are served by uvicorn through a small asgi app and the requests
+# to the matrix server are made with a pooled httpx client which keeps its
+# connections alive. The loop runs in its own thread, the public methods stay
+# blocking so the bridge can use both appservice implementations the same way.
+# They wait at most a grace period longer than the request timeout, so a
+# stuck loop does not block the calling thread forever.
+
+# Seconds the callers wait for the loop longer than the request takes.
+LOOP_GRACE = 5.0
+
+
+class _Response:
+    # Gives httpx responses the attributes of requests responses the
+    # matrix client relies on.
+    def __init__(self, res: httpx.Response):
+        self.status_code = res.status_code
+        self.headers = res.headers
+        self.content = res.content
+        self.ok = res.status_code < 400
+        self._res = res
+
+    def json(self):
+        return self._res.json()
+
+
+class AsyncAppservice(Appservice):
+    _transport_errors = (
+        httpx.HTTPError,
+        httpx.StreamError,
+        asyncio.TimeoutError,
+        FutureTimeoutError,
+    )
+
+    def __init__(
+        self,
+        matrix_server: str,
+        matrix_domain: str,
+        port: int,
+        ip: str,
+        as_token: str,
+        hs_token: str,
+        user_prefix: str,
+        dedup: Optional[DedupIndex] = None,
+        timeout: float = 10.0,
+        max_retries: int = 3,
+        rate_limiter: Optional[RateLimiter] = None,
+        admission: Optional[AdmissionControl] = None,
+        workers: int = 8,
+        max_connections: int = 20,
+    ):
+        super().__init__(
+            matrix_server,
+            matrix_domain,
+            port,
+            ip,
+            as_token,
+            hs_token,
+            user_prefix,
+            dedup,
+            timeout,
+            max_retries,
+            rate_limiter,
+            admission,
+        )
+        self._executor = ThreadPoolExecutor(max(1, workers), "appservice")
+
+        self._loop = asyncio.new_event_loop()
+        threading.Thread(
+            target=self._loop.run_forever, name="matrix-loop", daemon=True
+        ).start()
+        self._client = httpx.AsyncClient(
+            headers={"Authorization": f"Bearer {as_token}"},
+            limits=httpx.Limits(
+                max_connections=max_connections,
+                max_keepalive_connections=max_connections,
+            ),
+        )
+
+    def initialize(self, app=None) -> bool:
+        self._app = AsgiApp(self._endpoints(), self._executor)
+        return True
+
+    def serve(self):
+        config = uvicorn.Config(
+            self._app,
+            host=self._ip,
+            port=int(self._port),
+            lifespan="off",
+            log_config=None,
+        )
+        self._run(uvicorn.Server(config).serve(), None)
+        self._run(self._client.aclose(), self._timeout)
+        logging.info("past serve")
+
+    def download_media(
+        self, url: str, max_bytes: int, timeout: float
+    ) -> Optional[bytes]:
+        logging.debug("downloading media %s", url)
+        try:
+            return self._run(
+                self._download_media(url, max_bytes, timeout), timeout + LOOP_GRACE
+            )
+        except self._transport_errors:
+            logging.exception("error while getting media")
+            return None
+
+    async def _download_media(
+        self, url: str, max_bytes: int, timeout: float
+    ) -> Optional[bytes]:
+        deadline = time.monotonic() + timeout
+        async with self._client.stream("GET", url, timeout=timeout) as res:
+            if res.status_code >= 400:
+                return None
+            length = res.headers.get("Content-Length")
+            if length is not None and int(length) > max_bytes:
+                logging.info("media %s is too big (%s bytes)", url, length)
+                return None
+            data = bytearray()
+            async for chunk in res.aiter_bytes(64 * 1024):
+                data += chunk
+                if len(data) > max_bytes:
+                    logging.info("media %s is bigger than %d bytes", url, max_bytes)
+                    return None
+                if time.monotonic() > deadline:
+                    logging.info("download of media %s timed out", url)
+                    return None
+            return bytes(data)
+
+    def _send(self, method: str, url: str, **kwargs) -> _Response:
+        timeout = kwargs.get("timeout") or self._timeout
+        return self._run(self._async_send(method, url, **kwargs), timeout + LOOP_GRACE)
+
+    async def _async_send(
+        self,
+        method: str,
+        url: str,
+        params: Optional[dict] = None,
+        json=None,
+        data: Optional[bytes] = None,
+        headers: Optional[dict] = None,
+        timeout: Optional[float] = None,
+    ) -> _Response:
+        res = await self._client.request(
+            method,
+            url,
+            params=params,
+            json=json,
+            content=data,
+            headers=headers,
+            timeout=timeout,
+        )
+        return _Response(res)
+
+    def _run(self, coro, timeout: Optional[float]):
+        future = asyncio.run_coroutine_threadsafe(coro, self._loop)
+        try:
+            return future.result(timeout)
+        except FutureTimeoutError:
+            future.cancel()
+            raise FutureTimeoutError(f"no result from the loop in {timeout}s") from None
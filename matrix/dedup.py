@@ -0,0 +1,96 @@
+import threading
+from collections import OrderedDict
+from typing import Set
+
+# Bounded LRU index of already processed transaction and event ids.
+# The matrix server retries a transaction push if it did not get an answer
+# in time, with this index the retried events are not bridged a second time.
+# Keys which are being processed are claimed first, so a retry which arrives
+# while the first attempt is still running does not process them as well.
+#
+# If a storage is given the index is persisted, so it survives restarts.
+
+
+class DedupIndex:
+    def __init__(self, capacity: int = 10000, storage=None):
+        self._capacity = max(1, capacity)
+        self._storage = storage
+        self._lock = threading.Lock()
+        self._entries: "OrderedDict[str, None]" = OrderedDict()
+        self._in_flight: Set[str] = set()
+        self._seq = 0
+
+        self._hits = 0
+        self._misses = 0
+
+        if self._storage is not None:
+            self._load()
+
+    @property
+    def hits(self) -> int:
+        return self._hits
+
+    @property
+    def misses(self) -> int:
+        return self._misses
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def seen(self, key: str) -> bool:
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                self._hits += 1
+                return True
+            self._misses += 1
+            return False
+
+    def claim(self, key: str) -> bool:
+        # Returns False if the key was processed or is being processed,
+        # otherwise it has to be added or released when processing ends.
+        with self._lock:
+            if key in self._entries or key in self._in_flight:
+                return False
+            self._in_flight.add(key)
+            return True
+
+    def release(self, key: str):
+        # Gives up a claim, e.g. because processing failed.
+        with self._lock:
+            self._in_flight.discard(key)
+
+    def add(self, *keys: str):
+        rows = []
+        with self._lock:
+            for key in keys:
+                self._in_flight.discard(key)
+                self._seq += 1
+                self._entries[key] = None
+                self._entries.move_to_end(key)
+                rows.append((key, self._seq))
+            while len(self._entries) > self._capacity:
+                self._entries.popitem(last=False)
+            seq = self._seq
+        if self._storage is None or not rows:
+            return
+        self._storage.executemany(
+            "INSERT OR REPLACE INTO processed VALUES (?, ?)", rows
+        )
+        if seq % self._capacity < len(rows):
+            self._storage.execute(
+                "DELETE FROM processed WHERE seq <= ?", (seq - self._capacity,)
+            )
+
+    def _load(self):
+        self._storage.execute(
+            "CREATE TABLE IF NOT EXISTS processed (key TEXT PRIMARY KEY, seq INTEGER)"
+        )
+        rows = self._storage.query(
+            "SELECT key, seq FROM processed ORDER BY seq DESC LIMIT ?",
+            (self._capacity,),
+        )
+        for key, _ in reversed(rows):
+            self._entries[key] = None
+        if rows:
+            self._seq = rows[0][1]
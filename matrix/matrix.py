@@ -1,22 +1,68 @@
-from typing import Optional
-
 import logging
+import random
+import threading
+import time
+from typing import List, Optional
+
 import requests
 
+from metrics import MATRIX_REQUEST_SECONDS
+
+from .ratelimit import RateLimiter
+
+# Client for the matrix client-server API.
+#
+# All requests go through _request, which applies the rate limits, a timeout
+# and retries requests which were throttled (honoring the retry delay sent by
+# the server) or failed for temporary reasons, with a jittered backoff.
+
 
 class Matrix:
+    # Errors of the http client which are handled like a failed request.
+    _transport_errors: tuple = (requests.exceptions.RequestException,)
+
     def __init__(
         self,
         server: str,
         domain: str,
         bearer_token: str,
+        timeout: float = 10.0,
+        max_retries: int = 3,
+        rate_limiter: Optional[RateLimiter] = None,
     ):
         self._domain = domain
         self._client_api = f"{server}/_matrix/client/v3"
+        self._media_api = f"{server}/_matrix/media/v3"
 
         self._session = requests.Session()
         self._session.headers.update({"Authorization": f"Bearer {bearer_token}"})
 
+        self._timeout = timeout
+        self._max_retries = max_retries
+        self._rate_limiter = rate_limiter
+        # Retry delays asked by the server are not waited longer than a
+        # request may wait for the rate limiter.
+        self._max_retry_after = (
+            rate_limiter.max_wait if rate_limiter is not None else 30.0
+        )
+
+        self._stats_lock = threading.Lock()
+        self._throttled = 0
+        self._retried = 0
+        self._dropped = 0
+
+    @property
+    def throttled(self) -> int:
+        return self._throttled
+
+    @property
+    def retried(self) -> int:
+        return self._retried
+
+    @property
+    def dropped(self) -> int:
+        return self._dropped
+
     def create_room(self, alias_name: str, name: Optional[str]) -> Optional[str]:
         logging.debug("creating matrix room %s", alias_name)
         req = {
@@ -27,72 +73,260 @@ class Matrix:
         if name is not None:
             req["name"] = name
 
-        res = self._session.post(f"{self._client_api}/createRoom", json=req)
-        if not res.ok:
+        res = self._request(
+            "create_room",
+            "POST",
+            f"{self._client_api}/createRoom",
+            idempotent=False,
+            json=req,
+        )
+        if res is None or not res.ok:
             return None
         return res.json()["room_id"]
 
     def set_room_default_power(self, id: str, power: int) -> bool:
-        res = self._session.put(
+        res = self._request(
+            "set_room_default_power",
+            "PUT",
             f"{self._client_api}/rooms/{id}/state/m.room.power_levels",
             json={"users_default": power},
         )
-        return res.ok
+        return res is not None and res.ok
 
     def resolve_room_alias(self, alias_name: str) -> Optional[str]:
         logging.debug("resolving matrix room %s", alias_name)
-        res = self._session.get(
-            f"{self._client_api}/directory/room/%23{alias_name}:{self._domain}"
+        res = self._request(
+            "resolve_room_alias",
+            "GET",
+            f"{self._client_api}/directory/room/%23{alias_name}:{self._domain}",
         )
-        if not res.ok:
+        if res is None or not res.ok:
             return None
         return res.json()["room_id"]
 
     def register_user(self, name: str) -> bool:
-        res = self._session.post(
+        res = self._request(
+            "register_user",
+            "POST",
             f"{self._client_api}/register",
+            idempotent=False,
             json={"type": "m.login.application_service", "username": name},
         )
-        return res.ok
+        return res is not None and res.ok
 
     def user_join_room(self, user_name: str, room: str, reason: str) -> bool:
         logging.debug("user %s joining room %s", user_name, room)
         user_id = self._local_user_id(user_name)
-        res = self._session.post(
-            f"{self._client_api}/join/{room}?user_id={user_id}",
+        res = self._request(
+            "user_join_room",
+            "POST",
+            f"{self._client_api}/join/{room}",
+            user_id=user_id,
             json={"reason": reason},
         )
 
-        return res.ok
+        return res is not None and res.ok
 
     def user_leave_room(self, user_name: str, room: str, reason: str) -> bool:
         logging.debug("user %s leaving room %s", user_name, room)
         user_id = self._local_user_id(user_name)
-        res = self._session.post(
-            f"{self._client_api}/rooms/{room}/leave?user_id={user_id}",
+        res = self._request(
+            "user_leave_room",
+            "POST",
+            f"{self._client_api}/rooms/{room}/leave",
+            user_id=user_id,
             json={"reason": reason},
         )
-        return res.ok
+        return res is not None and res.ok
 
-    def user_send_msg(self, user_name: str, msg: str, room: str, txn: str) -> bool:
+    def room_joined_members(self, room: str) -> Optional[List[str]]:
+        logging.debug("getting joined members of room %s", room)
+        res = self._request(
+            "room_joined_members",
+            "GET",
+            f"{self._client_api}/rooms/{room}/joined_members",
+        )
+        if res is None or not res.ok:
+            return None
+        return list(res.json()["joined"])
+
+    def user_send_msg(
+        self,
+        user_name: str,
+        msg: str,
+        room: str,
+        txn: str,
+        formatted_msg: Optional[str] = None,
+    ) -> bool:
         logging.debug("user %s sending message to room %s", user_name, room)
         user_id = self._local_user_id(user_name)
-        res = self._session.put(
-            (
-                f"{self._client_api}/rooms/{room}/send/m.room.message/"
-                f"{txn}?user_id={user_id}"
-            ),
-            json={"msgtype": "m.text", "body": msg},
+        content = {"msgtype": "m.text", "body": msg}
+        if formatted_msg is not None:
+            content["format"] = "org.matrix.custom.html"
+            content["formatted_body"] = formatted_msg
+        res = self._request(
+            "user_send_msg",
+            "PUT",
+            f"{self._client_api}/rooms/{room}/send/m.room.message/{txn}",
+            user_id=user_id,
+            json=content,
+        )
+        return res is not None and res.ok
+
+    def user_send_image(
+        self, user_name: str, mxc_url: str, name: str, info: dict, room: str, txn: str
+    ) -> bool:
+        logging.debug("user %s sending image to room %s", user_name, room)
+        user_id = self._local_user_id(user_name)
+        res = self._request(
+            "user_send_image",
+            "PUT",
+            f"{self._client_api}/rooms/{room}/send/m.room.message/{txn}",
+            user_id=user_id,
+            json={"msgtype": "m.image", "body": name, "url": mxc_url, "info": info},
         )
-        return res.ok
+        return res is not None and res.ok
+
+    def upload_media(
+        self, data: bytes, content_type: str, filename: str
+    ) -> Optional[str]:
+        logging.debug("uploading media %s (%d bytes)", filename, len(data))
+        res = self._request(
+            "upload_media",
+            "POST",
+            f"{self._media_api}/upload",
+            idempotent=False,
+            params={"filename": filename},
+            data=data,
+            headers={"Content-Type": content_type},
+        )
+        if res is None or not res.ok:
+            return None
+        return res.json()["content_uri"]
 
     def user_exist(self, user_name: str) -> bool:
         logging.debug("checking if user %s exists", user_name)
         user_id = self._local_user_id(user_name)
-        res = self._session.get(
-            f"{self._client_api}/profile/{user_id}",
+        res = self._request(
+            "user_exist", "GET", f"{self._client_api}/profile/{user_id}"
         )
-        return res.ok
+        return res is not None and res.ok
+
+    def download_media(
+        self, url: str, max_bytes: int, timeout: float
+    ) -> Optional[bytes]:
+        logging.debug("downloading media %s", url)
+        deadline = time.monotonic() + timeout
+        try:
+            with self._session.get(url, stream=True, timeout=timeout) as res:
+                if not res.ok:
+                    return None
+                length = res.headers.get("Content-Length")
+                if length is not None and int(length) > max_bytes:
+                    logging.info("media %s is too big (%s bytes)", url, length)
+                    return None
+                data = bytearray()
+                for chunk in res.iter_content(64 * 1024):
+                    data += chunk
+                    if len(data) > max_bytes:
+                        logging.info("media %s is bigger than %d bytes", url, max_bytes)
+                        return None
+                    if time.monotonic() > deadline:
+                        logging.info("download of media %s timed out", url)
+                        return None
+                return bytes(data)
+        except requests.exceptions.RequestException:
+            logging.exception("error while getting media")
+            return None
 
     def _local_user_id(self, name: str) -> str:
         return f"@{name}:{self._domain}"
+
+    def _request(
+        self,
+        op: str,
+        method: str,
+        url: str,
+        user_id: Optional[str] = None,
+        idempotent: bool = True,
+        **kwargs,
+    ) -> Optional[requests.Response]:
+        with MATRIX_REQUEST_SECONDS.time(op=op):
+            return self._request_with_retries(
+                method, url, user_id, idempotent, **kwargs
+            )
+
+    def _request_with_retries(
+        self,
+        method: str,
+        url: str,
+        user_id: Optional[str],
+        idempotent: bool,
+        **kwargs,
+    ) -> Optional[requests.Response]:
+        if user_id is not None:
+            kwargs["params"] = {**kwargs.get("params", {}), "user_id": user_id}
+        kwargs.setdefault("timeout", self._timeout)
+
+        res = None
+        delay = 0.0
+        for attempt in range(self._max_retries + 1):
+            if attempt > 0:
+                self._count("_retried")
+                time.sleep(delay)
+
+            if self._rate_limiter is not None and not self._rate_limiter.acquire(
+                user_id
+            ):
+                logging.warning("rate limit for %s exceeded, dropping request", url)
+                self._count("_dropped")
+                return None
+
+            try:
+                res = self._send(method, url, **kwargs)
+            except self._transport_errors as e:
+                logging.warning("request to %s failed: %s", url, e)
+                res = None
+                if not idempotent:
+                    break
+                delay = self._backoff(attempt)
+                continue
+
+            if res.status_code == 429:
+                self._count("_throttled")
+                delay = self._retry_after(res, attempt)
+                if delay > self._max_retry_after:
+                    logging.warning(
+                        "throttled by matrix server for %.2fs, dropping request to %s",
+                        delay,
+                        url,
+                    )
+                    break
+                logging.info("throttled by matrix server, retrying in %.2fs", delay)
+            elif res.status_code >= 500 and idempotent:
+                delay = self._backoff(attempt)
+            else:
+                return res
+
+        self._count("_dropped")
+        return res
+
+    def _send(self, method: str, url: str, **kwargs) -> requests.Response:
+        return self._session.request(method, url, **kwargs)
+
+    def _count(self, counter: str):
+        with self._stats_lock:
+            setattr(self, counter, getattr(self, counter) + 1)
+
+    def _backoff(self, attempt: int) -> float:
+        return min(30.0, 0.5 * 2**attempt) * random.uniform(0.5, 1.0)
+
+    def _retry_after(self, res: requests.Response, attempt: int) -> float:
+        try:
+            return res.json()["retry_after_ms"] / 1000
+        except (ValueError, KeyError, TypeError):
+            pass
+        try:
+            return float(res.headers["Retry-After"])
+        except (KeyError, ValueError):
+            return self._backoff(attempt)
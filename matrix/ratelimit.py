@@ -0,0 +1,77 @@
+import threading
+import time
+from typing import Dict, Optional
+
+
+class TokenBucket:
+    def __init__(self, rate: float, burst: float):
+        self._rate = rate
+        self._burst = max(1.0, burst)
+        self._tokens = self._burst
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def reserve(self) -> float:
+        # Takes a token and returns how long the caller has to wait
+        # until the token is actually available.
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(
+                self._burst, self._tokens + (now - self._updated) * self._rate
+            )
+            self._updated = now
+            self._tokens -= 1
+            if self._tokens >= 0:
+                return 0.0
+            return -self._tokens / self._rate
+
+    def refund(self):
+        with self._lock:
+            self._tokens = min(self._burst, self._tokens + 1)
+
+
+# Limits the requests to the matrix server, globally and per puppet.
+# A rate of 0 disables the corresponding limit.
+
+
+class RateLimiter:
+    def __init__(
+        self,
+        rate: float = 20.0,
+        burst: float = 40.0,
+        user_rate: float = 2.0,
+        user_burst: float = 5.0,
+        max_wait: float = 30.0,
+    ):
+        self._global = TokenBucket(rate, burst) if rate > 0 else None
+        self._user_rate = user_rate
+        self._user_burst = user_burst
+        self._users: Dict[str, TokenBucket] = {}
+        self._lock = threading.Lock()
+        self._max_wait = max_wait
+
+    @property
+    def max_wait(self) -> float:
+        return self._max_wait
+
+    def acquire(self, user_id: Optional[str] = None) -> bool:
+        buckets = []
+        if self._global is not None:
+            buckets.append(self._global)
+        if user_id is not None and self._user_rate > 0:
+            with self._lock:
+                bucket = self._users.get(user_id)
+                if bucket is None:
+                    bucket = TokenBucket(self._user_rate, self._user_burst)
+                    self._users[user_id] = bucket
+            buckets.append(bucket)
+
+        waits = [bucket.reserve() for bucket in buckets]
+        wait = max(waits, default=0.0)
+        if wait > self._max_wait:
+            for bucket in buckets:
+                bucket.refund()
+            return False
+        if wait > 0:
+            time.sleep(wait)
+        return True
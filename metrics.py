@@ -0,0 +1,252 @@
+import bisect
+import threading
+import time
+from typing import Callable, Dict, List, Sequence, Tuple, Union
+
+import tracing
+
+# Minimal metrics in the prometheus text format, rendered by the /metrics
+# endpoint of the appservice. Metrics are created once at module level by the
+# code that records them, values of other components (queue depths, cache
+# counters, ...) are read through callbacks when the metrics are rendered.
+# Observations of histograms are also recorded as spans of the current
+# traces, see the tracing module.
+
+LATENCY_BUCKETS = (
+    0.0005,
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+    10.0,
+    30.0,
+)
+
+LabelValues = Tuple[str, ...]
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(names: Sequence[str], values: Sequence[str]) -> str:
+    if not names:
+        return ""
+    pairs = ",".join(
+        f'{name}="{_escape(str(value))}"' for name, value in zip(names, values)
+    )
+    return "{" + pairs + "}"
+
+
+class _Metric:
+    type = ""
+
+    def __init__(self, name: str, help: str, labels: Sequence[str] = ()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self._lock = threading.Lock()
+
+    def _key(self, labels: Dict[str, str]) -> LabelValues:
+        return tuple(str(labels.get(name, "")) for name in self.labels)
+
+    def header(self) -> List[str]:
+        return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.type}"]
+
+    def render(self) -> List[str]:
+        raise NotImplementedError
+
+
+class Counter(_Metric):
+    type = "counter"
+
+    def __init__(self, name: str, help: str, labels: Sequence[str] = ()):
+        super().__init__(name, help, labels)
+        self._values: Dict[LabelValues, float] = {}
+
+    def inc(self, amount: float = 1.0, **labels: str):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+    def render(self) -> List[str]:
+        with self._lock:
+            values = list(self._values.items())
+        return self.header() + [
+            f"{self.name}{_format_labels(self.labels, key)} {value}"
+            for key, value in values
+        ]
+
+
+class _Timer:
+    def __init__(self, histogram: "Histogram", labels: Dict[str, str]):
+        self._histogram = histogram
+        self._labels = labels
+        self._start = 0.0
+
+    def __enter__(self):
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, *_):
+        self._histogram.observe(time.perf_counter() - self._start, **self._labels)
+
+
+class Histogram(_Metric):
+    type = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        help: str,
+        labels: Sequence[str] = (),
+        buckets: Sequence[float] = LATENCY_BUCKETS,
+    ):
+        super().__init__(name, help, labels)
+        self._buckets = tuple(sorted(buckets))
+        # Per label values: count per bucket (the last one is +Inf) and the sum.
+        self._values: Dict[LabelValues, Tuple[List[int], List[float]]] = {}
+        # e.g. mandm_image_seconds with step="resize" becomes the span image:resize.
+        self._span_name = name.replace("mandm_", "", 1).replace("_seconds", "")
+
+    def observe(self, value: float, **labels: str):
+        key = self._key(labels)
+        if tracing.current():
+            tracing.record(":".join((self._span_name,) + key), value)
+        index = bisect.bisect_left(self._buckets, value)
+        with self._lock:
+            counts, total = self._values.setdefault(
+                key, ([0] * (len(self._buckets) + 1), [0.0])
+            )
+            counts[index] += 1
+            total[0] += value
+
+    def time(self, **labels: str) -> _Timer:
+        return _Timer(self, labels)
+
+    def render(self) -> List[str]:
+        with self._lock:
+            values = [
+                (key, list(counts), total[0])
+                for key, (counts, total) in self._values.items()
+            ]
+        lines = self.header()
+        for key, counts, total in values:
+            cumulative = 0
+            for bound, count in zip(self._buckets + (float("inf"),), counts):
+                cumulative += count
+                le = "+Inf" if bound == float("inf") else repr(bound)
+                lines.append(
+                    f"{self.name}_bucket"
+                    f"{_format_labels(self.labels + ('le',), key + (le,))} {cumulative}"
+                )
+            lines.append(f"{self.name}_sum{_format_labels(self.labels, key)} {total}")
+            lines.append(
+                f"{self.name}_count{_format_labels(self.labels, key)} {cumulative}"
+            )
+        return lines
+
+
+class Callback(_Metric):
+    # Metric whose value is read from a function when rendered. The function
+    # returns a single value or a dict from label values to values.
+
+    def __init__(
+        self,
+        name: str,
+        help: str,
+        type: str,
+        fn: Callable[[], Union[float, Dict[LabelValues, float]]],
+        labels: Sequence[str] = (),
+    ):
+        super().__init__(name, help, labels)
+        self.type = type
+        self._fn = fn
+
+    def render(self) -> List[str]:
+        value = self._fn()
+        values = value if isinstance(value, dict) else {(): value}
+        return self.header() + [
+            f"{self.name}{_format_labels(self.labels, key)} {float(value)}"
+            for key, value in values.items()
+        ]
+
+
+class Registry:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._metrics: Dict[str, _Metric] = {}
+
+    def register(self, metric: _Metric) -> _Metric:
+        with self._lock:
+            self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name: str, help: str, labels: Sequence[str] = ()) -> Counter:
+        return self.register(Counter(name, help, labels))
+
+    def histogram(
+        self,
+        name: str,
+        help: str,
+        labels: Sequence[str] = (),
+        buckets: Sequence[float] = LATENCY_BUCKETS,
+    ) -> Histogram:
+        return self.register(Histogram(name, help, labels, buckets))
+
+    def gauge_fn(
+        self, name: str, help: str, fn: Callable, labels: Sequence[str] = ()
+    ) -> Callback:
+        return self.register(Callback(name, help, "gauge", fn, labels))
+
+    def counter_fn(
+        self, name: str, help: str, fn: Callable, labels: Sequence[str] = ()
+    ) -> Callback:
+        return self.register(Callback(name, help, "counter", fn, labels))
+
+    def render(self) -> str:
+        with self._lock:
+            metrics = list(self._metrics.values())
+        lines = []
+        for metric in metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+EVENTS = REGISTRY.counter(
+    "mandm_events_total", "Bridged events.", ("direction", "type")
+)
+TRANSACTION_SECONDS = REGISTRY.histogram(
+    "mandm_transaction_seconds", "Time to process a pushed matrix transaction."
+)
+HANDLER_SECONDS = REGISTRY.histogram(
+    "mandm_handler_seconds", "Time spent in a message handler.", ("handler",)
+)
+IMAGE_SECONDS = REGISTRY.histogram(
+    "mandm_image_seconds",
+    "Time spent in a step of the image pipeline.",
+    ("step",),
+)
+MATRIX_REQUEST_SECONDS = REGISTRY.histogram(
+    "mandm_matrix_request_seconds",
+    "Duration of requests to the matrix server, including retries.",
+    ("op",),
+)
+MURMUR_RPC_SECONDS = REGISTRY.histogram(
+    "mandm_murmur_rpc_seconds", "Duration of ice calls to murmur.", ("rpc",)
+)
+ICE_CALLBACK_SECONDS = REGISTRY.histogram(
+    "mandm_ice_callback_seconds",
+    "Time the murmur callbacks block the ice dispatch thread.",
+    ("callback",),
+)
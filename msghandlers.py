@@ -1,6 +1,25 @@
-import re
+import logging
+import time
+from functools import partial
+from importlib.metadata import EntryPoint, entry_points
+from typing import Callable, Dict, List, Optional, Tuple
 
-from typing import Tuple
+from htmlconvert import unwrap_links
+from metrics import HANDLER_SECONDS
+
+# Message handlers get the sender and the message and return if the message
+# should be bridged and the (modified) message. Handlers starting with
+# "matrix" are applied to messages from matrix, handlers starting with
+# "murmur" to messages from murmur.
+#
+# Additional handlers can be provided by other packages with an entry point in
+# the group below. The entry point name is the handler name, it has to point to
+# a handler function or a class whose instances are handler functions.
+
+ENTRY_POINT_GROUP = "mandm_bridge.msg_handlers"
+
+Handler = Callable[[str, str], Tuple[bool, str]]
+HandlerLoader = Callable[[], Optional[Handler]]
 
 
 class MsgHandlers:
@@ -10,5 +29,58 @@ class MsgHandlers:
         return True, msg
 
     def murmur_remove_html(self, _, msg: str) -> Tuple[bool, str]:
-        msg = re.sub('<a href="(.*)">.*<\\/a>', "\\1", msg)
+        return True, unwrap_links(msg)
+
+
+class HandlerChain:
+    def __init__(self, handlers: List[Tuple[str, Handler]]):
+        self._handlers = tuple(handlers)
+
+    def __len__(self) -> int:
+        return len(self._handlers)
+
+    def __call__(self, sender: str, msg: str) -> Tuple[bool, str]:
+        for name, handler in self._handlers:
+            start = time.perf_counter()
+            send, msg = handler(sender, msg)
+            HANDLER_SECONDS.observe(time.perf_counter() - start, handler=name)
+            if not send:
+                return False, msg
         return True, msg
+
+
+def available_msg_handlers() -> Dict[str, HandlerLoader]:
+    # Only lists the handlers, entry points are imported and instantiated by
+    # their loader, so only the enabled handlers are loaded.
+    builtin = MsgHandlers()
+    handlers: Dict[str, HandlerLoader] = {
+        name: partial(getattr, builtin, name)
+        for name in dir(MsgHandlers)
+        if callable(getattr(MsgHandlers, name)) and not name.startswith("__")
+    }
+    for entry_point in entry_points(group=ENTRY_POINT_GROUP):
+        handlers[entry_point.name] = partial(_load_entry_point, entry_point)
+    return handlers
+
+
+def _load_entry_point(entry_point: EntryPoint) -> Optional[Handler]:
+    try:
+        handler = entry_point.load()
+        return handler() if isinstance(handler, type) else handler
+    except Exception:
+        logging.exception("could not load message handler %s", entry_point.name)
+        return None
+
+
+def build_handler_chains(enabled: Dict[str, Handler]) -> Dict[str, HandlerChain]:
+    # Takes the enabled handlers in the order they are applied.
+    return {
+        direction: HandlerChain(
+            [
+                (name, handler)
+                for name, handler in enabled.items()
+                if name.startswith(direction)
+            ]
+        )
+        for direction in ("matrix", "murmur")
+    }
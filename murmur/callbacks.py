@@ -1,69 +1,126 @@
+import functools
 import logging
-from typing import Callable, List, Optional
+from typing import Callable, FrozenSet
 
-import Ice
+import tracing
+from logpipeline import Body
+from metrics import EVENTS, ICE_CALLBACK_SECONDS
 
-Ice.loadSlice("-I" + Ice.getSliceDir(), ["ressources/Murmur.ice"])
-import Murmur  # noqa: E402
+from .channels import ChannelIndex
+from .slice import Murmur
+
+
+def _timed(callback):
+    # Records how long a callback blocks the ice dispatch thread.
+    name = callback.__name__
+
+    @functools.wraps(callback)
+    def wrapper(self, *args):
+        with ICE_CALLBACK_SECONDS.time(callback=name):
+            return callback(self, *args)
+
+    return wrapper
+
+
+def _traced(callback):
+    # Starts a trace around the callback, outside of _timed so the time in
+    # the callback is part of it.
+    name = callback.__name__
+
+    @functools.wraps(callback)
+    def wrapper(self, *args):
+        with tracing.trace(name):
+            return callback(self, *args)
+
+    return wrapper
 
 
 class ServerCallbacks(Murmur.ServerCallback):
-    def __init__(self, channel_filter: Optional[List[str]]):
+    def __init__(self, channels: ChannelIndex):
         self._on_msg_cb = None
         self._on_connection_cb = None
-        self._channel_filter = channel_filter
+        self._channels = channels
 
     @property
-    def on_msg_cb(self) -> Callable[[str, str], bool]:
+    def on_msg_cb(self) -> Callable[[str, str, str], bool]:
         return self._on_msg_cb
 
     @on_msg_cb.setter
-    def on_msg_cb(self, cb: Callable[[str, str], bool]):
+    def on_msg_cb(self, cb: Callable[[str, str, str], bool]):
         self._on_msg_cb = cb
 
     @property
-    def on_connection_cb(self) -> Callable[[str, str], bool]:
+    def on_connection_cb(self) -> Callable[[FrozenSet[str], str, str], bool]:
         return self._on_connection_cb
 
     @on_connection_cb.setter
-    def on_connection_cb(self, cb: Callable[[str, str], bool]):
+    def on_connection_cb(self, cb: Callable[[FrozenSet[str], str, str], bool]):
         self._on_connection_cb = cb
 
+    @_traced
+    @_timed
     def userTextMessage(self, p, msg, _):
+        if len(msg.channels) == 0:
+            return
         logging.debug(
-            "got a message in channel %s from %s: %s", msg.channels[0], p.name, msg.text
+            "got a message in channel %s from %s: %s",
+            msg.channels[0],
+            p.name,
+            Body(msg.text),
         )
 
         if self._on_msg_cb is None:
             return
-        if len(msg.channels) == 0:
-            return
-        if (
-            self._channel_filter is not None
-            and msg.channels[0] not in self._channel_filter
-        ):
+        room = self._channels.room(msg.channels[0])
+        if room is None:
             logging.debug(
                 "channel %s is not bridged, omitting message", msg.channels[0]
             )
             return
 
-        self._on_msg_cb(p.name, msg.text)
+        EVENTS.inc(direction="murmur_to_matrix", type="text")
+        self._on_msg_cb(room, p.name, msg.text)
 
+    @_timed
     def userDisconnected(self, p, _):
         logging.debug("%s disconnected", p.name)
 
         if self._on_connection_cb is None:
             return
 
-        self._on_connection_cb(p.name, "disconnected")
+        EVENTS.inc(direction="murmur_to_matrix", type="disconnected")
+        # The user may have joined rooms in other channels before, leaving a
+        # room the user is not in does nothing.
+        self._on_connection_cb(self._channels.rooms, p.name, "disconnected")
 
+    @_timed
     def userConnected(self, p, _):
         logging.debug("%s connected", p.name)
 
         if self._on_connection_cb is None:
             return
 
-        self._on_connection_cb(p.name, "connected")
+        rooms = self._channels.presence_rooms(p.channel)
+        if not rooms:
+            logging.debug("channel %s is not bridged, omitting connect", p.channel)
+            return
+
+        EVENTS.inc(direction="murmur_to_matrix", type="connected")
+        self._on_connection_cb(rooms, p.name, "connected")
 
     def userStateChanged(self, p, _):
         pass
+
+    @_timed
+    def channelCreated(self, state, _):
+        logging.debug("channel %s (%d) created", state.name, state.id)
+        self._channels.update(state.id, state.name)
+
+    @_timed
+    def channelRemoved(self, state, _):
+        logging.debug("channel %s (%d) removed", state.name, state.id)
+        self._channels.remove(state.id)
+
+    @_timed
+    def channelStateChanged(self, state, _):
+        self._channels.update(state.id, state.name)
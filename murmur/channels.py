@@ -0,0 +1,99 @@
+import logging
+import threading
+from typing import Dict, FrozenSet, Iterable, Optional
+
+# Maps channel names of one murmur server to the matrix room they are bridged
+# to. The None key matches every channel without an own entry.
+ChannelRoutes = Dict[Optional[str], str]
+
+# Index of the channels of a murmur server, kept up to date by the channel
+# callbacks. The routing tables (channel id to room and room to channel ids)
+# are rebuilt on every change and replaced as a whole, so readers can use
+# them without locking.
+
+
+class ChannelIndex:
+    def __init__(self, routes: ChannelRoutes):
+        self._routes = dict(routes)
+        self._lock = threading.Lock()
+        self._names: Dict[int, str] = {}
+        self._rooms: Dict[int, str] = {}
+        self._channels: Dict[str, FrozenSet[int]] = {}
+        self._bridged: FrozenSet[int] = frozenset()
+
+    def __len__(self) -> int:
+        return len(self._names)
+
+    @property
+    def bridged(self) -> FrozenSet[int]:
+        return self._bridged
+
+    @property
+    def rooms(self) -> FrozenSet[str]:
+        return frozenset(self._routes.values())
+
+    def is_bridged(self, id: int) -> bool:
+        return id in self._bridged
+
+    def name(self, id: int) -> Optional[str]:
+        return self._names.get(id)
+
+    def room(self, id: int) -> Optional[str]:
+        return self._rooms.get(id)
+
+    def channels(self, room: str) -> FrozenSet[int]:
+        return self._channels.get(room, frozenset())
+
+    def presence_rooms(self, id: int) -> FrozenSet[str]:
+        # The rooms a user in this channel is present in: the room of the
+        # channel and the room of all other channels, if there is one.
+        rooms = {self._rooms.get(id), self._routes.get(None)}
+        rooms.discard(None)
+        return frozenset(rooms)
+
+    def update(self, id: int, name: str):
+        with self._lock:
+            if self._names.get(id) == name:
+                return
+            self._names[id] = name
+            self._rebuild()
+
+    def remove(self, id: int):
+        with self._lock:
+            if self._names.pop(id, None) is None:
+                return
+            self._rebuild()
+
+    def sync(self, channels: Iterable) -> int:
+        # Applies the difference to the given channel states and returns the
+        # number of changed channels.
+        names = {chan.id: chan.name for chan in channels}
+        with self._lock:
+            changed = sum(
+                1 for id, name in names.items() if self._names.get(id) != name
+            ) + sum(1 for id in self._names if id not in names)
+            if changed:
+                self._names = names
+                self._rebuild()
+        return changed
+
+    def _rebuild(self):
+        default = self._routes.get(None)
+        rooms = {}
+        for id, name in self._names.items():
+            room = self._routes.get(name, default)
+            if room is not None:
+                rooms[id] = room
+        channels: Dict[str, set] = {}
+        for id, room in rooms.items():
+            channels.setdefault(room, set()).add(id)
+
+        self._rooms = rooms
+        self._channels = {room: frozenset(ids) for room, ids in channels.items()}
+        self._bridged = frozenset(rooms)
+        logging.debug(
+            "channel index has %d channels, %d bridged to %d rooms",
+            len(self._names),
+            len(self._bridged),
+            len(self._channels),
+        )
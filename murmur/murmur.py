@@ -1,12 +1,39 @@
 from .callbacks import ServerCallbacks
+from .channels import ChannelIndex, ChannelRoutes
+from .slice import Murmur
 
 import logging
-from typing import Callable, List, Optional
+import random
+import threading
+import time
+from typing import Callable, Dict, FrozenSet, Optional, Set
 
 import Ice
 
-Ice.loadSlice("-I" + Ice.getSliceDir(), ["ressources/Murmur.ice"])
-import Murmur  # noqa: E402
+from logpipeline import Body
+from metrics import MURMUR_RPC_SECONDS
+
+# A virtual server of murmur, with its own channels and callbacks.
+
+
+class VirtualServer:
+    def __init__(self, id: int, routes: ChannelRoutes):
+        self.id = id
+        self.channels = ChannelIndex(routes)
+        self.callbacks = ServerCallbacks(self.channels)
+        self.callbacks_prx = None
+        self.prx = None
+
+
+# Connects to the Meta interface of murmur and bridges any number of its
+# virtual servers. All servers share one communicator and one callback
+# adapter, events are routed by the channel index of their server.
+#
+# A supervisor thread watches the connection: it is marked as lost when Ice
+# closes it (ACM heartbeats make sure a dead peer is noticed) or a periodic
+# ping fails. It then reconnects with exponential backoff, registers the
+# callbacks again, since a restarted murmur forgot them, reloads the channel
+# indexes and notifies the reconnect callback.
 
 
 class MurmurICE:
@@ -14,58 +41,144 @@ class MurmurICE:
         self,
         hostname: str,
         port: str,
-        server_id: int,
         secret: str,
-        channel_filter: Optional[List[str]],
+        routes: Dict[int, ChannelRoutes],
+        channel_check_interval: float = 300.0,
+        acm_timeout: int = 30,
+        ping_interval: float = 10.0,
+        reconnect_delay: float = 1.0,
+        reconnect_max_delay: float = 60.0,
+        thread_pool_size: int = 1,
+        serialize_callbacks: bool = True,
     ):
         self._hostname = hostname
         self._port = port
-        self._server_id = server_id
         self._secret = secret
 
-        self._channel_filter = channel_filter
-        self._server_cbs = ServerCallbacks(channel_filter)
+        self._servers = {
+            server_id: VirtualServer(server_id, server_routes)
+            for server_id, server_routes in routes.items()
+        }
+        self._on_msg_cb = None
+        self._on_connection_cb = None
+        self._on_reconnect_cb = None
 
         self._comm = None
+        self._adapter = None
         self._meta_prx = None
-        self._server = None
-        self._channels = None
+
+        self._channel_check_interval = channel_check_interval
+        self._acm_timeout = acm_timeout
+        self._ping_interval = ping_interval
+        self._reconnect_delay = reconnect_delay
+        self._reconnect_max_delay = max(reconnect_delay, reconnect_max_delay)
+        self._thread_pool_size = max(1, thread_pool_size)
+        self._serialize_callbacks = serialize_callbacks
+        self._stop = threading.Event()
+        self._lost = threading.Event()
+        self._reconnects = 0
+
+        self._fanouts = 0
+        self._fanout_seconds = 0.0
 
     @property
-    def on_msg_cb(self) -> Callable[[str, str], bool]:
-        return self._server.on_msg_cb
+    def on_msg_cb(self) -> Callable[[str, str, str], bool]:
+        return self._on_msg_cb
 
     @on_msg_cb.setter
-    def on_msg_cb(self, cb: Callable[[str, str], bool]):
-        self._server_cbs.on_msg_cb = cb
+    def on_msg_cb(self, cb: Callable[[str, str, str], bool]):
+        self._on_msg_cb = cb
+        for server in self._servers.values():
+            server.callbacks.on_msg_cb = cb
 
     @property
-    def on_connection_cb(self) -> Callable[[str, str], bool]:
-        return self._server.on_connection_cb
+    def on_connection_cb(self) -> Callable[[FrozenSet[str], str, str], bool]:
+        return self._on_connection_cb
 
     @on_connection_cb.setter
-    def on_connection_cb(self, cb: Callable[[str, str], bool]):
-        self._server_cbs.on_connection_cb = cb
+    def on_connection_cb(self, cb: Callable[[FrozenSet[str], str, str], bool]):
+        self._on_connection_cb = cb
+        for server in self._servers.values():
+            server.callbacks.on_connection_cb = cb
+
+    @property
+    def on_reconnect_cb(self) -> Callable[[], bool]:
+        return self._on_reconnect_cb
+
+    @on_reconnect_cb.setter
+    def on_reconnect_cb(self, cb: Callable[[], bool]):
+        self._on_reconnect_cb = cb
+
+    @property
+    def rooms(self) -> FrozenSet[str]:
+        return frozenset().union(
+            *(server.channels.rooms for server in self._servers.values())
+        )
+
+    @property
+    def fanouts(self) -> int:
+        return self._fanouts
+
+    @property
+    def fanout_seconds(self) -> float:
+        return self._fanout_seconds
+
+    @property
+    def connected(self) -> bool:
+        return not self._lost.is_set()
+
+    @property
+    def reconnects(self) -> int:
+        return self._reconnects
 
     def initialize(self) -> bool:
-        if not self._connect():
-            return False
-        if not self._select_server():
+        self._connect()
+        self._adapter = self._comm.createObjectAdapterWithEndpoints(
+            "Callback.Client", "tcp -h 127.0.0.1"
+        )
+        self._adapter.activate()
+        for server in self._servers.values():
+            server.callbacks_prx = Murmur.ServerCallbackPrx.uncheckedCast(
+                self._adapter.addWithUUID(server.callbacks)
+            )
+        if not self._attach():
             return False
-        self._setup_callbacks()
-        self._load_channels()
+        threading.Thread(
+            target=self._supervise, name="ice-supervisor", daemon=True
+        ).start()
+        if self._channel_check_interval > 0:
+            threading.Thread(
+                target=self._check_channels, name="channel-check", daemon=True
+            ).start()
 
-        logging.info("initialized connection to murmur ice interface")
+        logging.info(
+            "initialized connection to murmur ice interface, %d servers",
+            len(self._servers),
+        )
         return True
 
     def cleanup(self):
+        self._stop.set()
         self._comm.destroy()
 
-    def _connect(self) -> bool:
+    def _connect(self):
         props = Ice.createProperties([])
         props.setProperty("Ice.ImplicitContext", "Shared")
         props.setProperty("Ice.Default.EncodingVersion", "1.0")
         props.setProperty("Ice.MessageSizeMax", "65536")
+        # Heartbeats keep the connection to murmur open while it is idle and
+        # let Ice notice a dead peer, instead of closing idle connections.
+        props.setProperty("Ice.ACM.Client.Heartbeat", "3")  # HeartbeatAlways
+        props.setProperty("Ice.ACM.Client.Close", "0")  # CloseOff
+        props.setProperty("Ice.ACM.Client.Timeout", str(self._acm_timeout))
+        # The callbacks of murmur are dispatched by the server thread pool.
+        # With serialization, the events of a connection, and so the events
+        # of a user, are dispatched one after another even with more threads.
+        props.setProperty("Ice.ThreadPool.Server.Size", "1")
+        props.setProperty("Ice.ThreadPool.Server.SizeMax", str(self._thread_pool_size))
+        props.setProperty(
+            "Ice.ThreadPool.Server.Serialize", "1" if self._serialize_callbacks else "0"
+        )
 
         init_data = Ice.InitializationData()
         init_data.properties = props
@@ -73,52 +186,178 @@ class MurmurICE:
         self._comm = Ice.initialize(init_data)
         self._comm.getImplicitContext().put("secret", self._secret)
 
+    def _attach(self) -> bool:
+        # Obtains the proxies, registers the callbacks and loads the channels,
+        # on the first connect and on every reconnect.
         prx = self._comm.stringToProxy(f"Meta:tcp -h {self._hostname} -p {self._port}")
 
-        self._meta_prx = Murmur.MetaPrx.checkedCast(prx)
+        with MURMUR_RPC_SECONDS.time(rpc="checkedCast"):
+            self._meta_prx = Murmur.MetaPrx.checkedCast(prx)
         if not self._meta_prx:
             logging.critical("failed to obtain meta proxy")
             return False
-
         logging.debug("obtained meta proxy")
+
+        for server in self._servers.values():
+            if not self._select_server(server):
+                return False
+            self._setup_callbacks(server)
+            self._load_channels(server)
+
+        self._lost.clear()
+        # IcePy only accepts plain functions here, not bound methods.
+        self._meta_prx.ice_getConnection().setCloseCallback(
+            lambda connection: self._on_close(connection)
+        )
+        return True
+
+    def _on_close(self, connection):
+        if not self._stop.is_set():
+            logging.warning("connection to murmur was closed")
+            self._lost.set()
+
+    def _ping(self) -> bool:
+        try:
+            with MURMUR_RPC_SECONDS.time(rpc="ping"):
+                self._meta_prx.ice_invocationTimeout(
+                    int(self._acm_timeout * 1000)
+                ).ice_ping()
+        except Ice.Exception as e:
+            logging.warning("ping of murmur failed: %s", e)
+            return False
         return True
 
-    def _select_server(self) -> bool:
-        self._server = self._meta_prx.getServer(self._server_id)
-        if not self._server:
-            logging.critical("murmur server %d does not exist", self._server_id)
+    def _supervise(self):
+        while not self._stop.is_set():
+            if not self._lost.wait(self._ping_interval):
+                if self._stop.is_set() or self._ping():
+                    continue
+                self._lost.set()
+            self._reconnect()
+
+    def _reconnect(self):
+        delay = self._reconnect_delay
+        while not self._stop.is_set():
+            try:
+                attached = self._attach()
+            except Ice.Exception as e:
+                logging.warning("could not reconnect to murmur: %s", e)
+                attached = False
+            if attached:
+                break
+            # The jitter spreads out the reconnects of several bridges.
+            self._stop.wait(delay * random.uniform(0.5, 1.0))
+            delay = min(delay * 2, self._reconnect_max_delay)
+        else:
+            return
+
+        self._reconnects += 1
+        logging.info("reconnected to murmur ice interface")
+        if self._on_reconnect_cb is not None:
+            self._on_reconnect_cb()
+
+    def _select_server(self, server: VirtualServer) -> bool:
+        with MURMUR_RPC_SECONDS.time(rpc="getServer"):
+            server.prx = self._meta_prx.getServer(server.id)
+        if not server.prx:
+            logging.critical("murmur server %d does not exist", server.id)
             return False
 
-        logging.debug("selected server %d", self._server_id)
+        logging.debug("selected server %d", server.id)
         return True
 
-    def _setup_callbacks(self):
-        adapter = self._comm.createObjectAdapterWithEndpoints(
-            "Callback.Client", "tcp -h 127.0.0.1"
-        )
-        adapter.activate()
-        server_cbs_prx = Murmur.ServerCallbackPrx.uncheckedCast(
-            adapter.addWithUUID(self._server_cbs)
+    def _setup_callbacks(self, server: VirtualServer):
+        # After a lost connection murmur may still know the callback, it is
+        # removed first so events are not delivered twice.
+        try:
+            with MURMUR_RPC_SECONDS.time(rpc="removeCallback"):
+                server.prx.removeCallback(server.callbacks_prx)
+        except Murmur.InvalidCallbackException:
+            pass
+        with MURMUR_RPC_SECONDS.time(rpc="addCallback"):
+            server.prx.addCallback(server.callbacks_prx)
+
+    def _load_channels(self, server: VirtualServer):
+        server.channels.sync(self._get_channels(server))
+        logging.debug(
+            "loaded %d channels of server %d, %d bridged",
+            len(server.channels),
+            server.id,
+            len(server.channels.bridged),
         )
-        self._server.addCallback(server_cbs_prx)
 
-    def _load_channels(self):
-        chan_info = self._server.getChannels().values()
-        self._channels = {chan.name: chan.id for chan in chan_info}
-        logging.debug("loaded %d channels", len(self._channels))
+    def _check_channels(self):
+        # The index is kept up to date by the channel callbacks, this only
+        # catches events that got lost, e.g. while the connection was down.
+        while not self._stop.wait(self._channel_check_interval):
+            if self._lost.is_set():
+                # Reloaded by the supervisor after reconnecting.
+                continue
+            for server in self._servers.values():
+                try:
+                    changed = server.channels.sync(self._get_channels(server))
+                except Ice.Exception:
+                    logging.exception(
+                        "could not check channels of murmur server %d", server.id
+                    )
+                    continue
+                if changed:
+                    logging.warning(
+                        "channel index of server %d was out of sync, %d changes",
+                        server.id,
+                        changed,
+                    )
 
-    def _send_channel_msg(self, channel: str, msg: str) -> bool:
-        if channel not in self._channels:
-            logging.debug("channel %s not found", channel)
-            return False
-        channel_id = self._channels[channel]
-        if self._channel_filter is not None and channel_id not in self._channel_filter:
-            logging.debug("channel %s is not bridged, omitting message", channel_id)
-            return True
-        self._server.sendMessageChannel(channel_id, False, msg)
-        if len(msg) < 500:
-            logging.debug("sent %s to channel %s", msg, channel)
-
-    def send_msg(self, msg: str):
-        for channel in self._channels:
-            self._send_channel_msg(channel, msg)
+    def _get_channels(self, server: VirtualServer):
+        with MURMUR_RPC_SECONDS.time(rpc="getChannels"):
+            return server.prx.getChannels().values()
+
+    def online_users(self) -> Optional[Dict[str, Set[str]]]:
+        # Returns the names of the online users per bridged room, by the
+        # channel they are in, with one call per virtual server.
+        users: Dict[str, Set[str]] = {room: set() for room in self.rooms}
+        for server in self._servers.values():
+            try:
+                with MURMUR_RPC_SECONDS.time(rpc="getUsers"):
+                    online = server.prx.getUsers().values()
+            except Ice.Exception:
+                logging.exception("could not get users of murmur server %d", server.id)
+                return None
+            for user in online:
+                for room in server.channels.presence_rooms(user.channel):
+                    users[room].add(user.name)
+        return users
+
+    def send_msg(self, room: str, msg: str) -> bool:
+        # All channel messages are sent asynchronously first and awaited
+        # afterwards, so the rpcs are pipelined instead of one round trip
+        # per channel.
+        start = time.monotonic()
+        pending = [
+            (
+                server.id,
+                channel_id,
+                server.prx.sendMessageChannelAsync(channel_id, False, msg),
+            )
+            for server in self._servers.values()
+            for channel_id in server.channels.channels(room)
+        ]
+        sent = True
+        for server_id, channel_id, future in pending:
+            try:
+                future.result()
+            except Ice.Exception:
+                sent = False
+                logging.exception(
+                    "could not send message to channel %d of server %d",
+                    channel_id,
+                    server_id,
+                )
+        elapsed = time.monotonic() - start
+        MURMUR_RPC_SECONDS.observe(elapsed, rpc="sendMessageChannel")
+        self._fanouts += 1
+        self._fanout_seconds += elapsed
+        logging.debug(
+            "sent %s to %d channels in %.3fs", Body(msg), len(pending), elapsed
+        )
+        return sent
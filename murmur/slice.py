@@ -0,0 +1,84 @@
+import glob
+import hashlib
+import importlib.util
+import logging
+import os
+import tempfile
+import time
+from typing import Optional
+
+import Ice
+import IcePy
+
+# Loads the Murmur slice definitions.
+# By default the slice file is parsed at every start with Ice.loadSlice. If
+# the MANDM_SLICE_CACHE environment variable points to a directory, the
+# python module generated by slice2py is kept there and only regenerated
+# when the slice file or the Ice version changes.
+
+SLICE_FILE = "ressources/Murmur.ice"
+CACHE_ENV = "MANDM_SLICE_CACHE"
+
+# Seconds it took to load the slice definitions, for the startup report.
+load_seconds = 0.0
+
+
+def _slice_digest(slice_file: str) -> str:
+    digest = hashlib.sha256(Ice.stringVersion().encode("ascii"))
+    with open(slice_file, "rb") as file:
+        digest.update(file.read())
+    return digest.hexdigest()[:16]
+
+
+def _compile(slice_file: str, cache_dir: str, target: str) -> bool:
+    with tempfile.TemporaryDirectory(dir=cache_dir) as tmp:
+        status = IcePy.compile(
+            [
+                "slice2py",
+                "-I" + Ice.getSliceDir(),
+                "--output-dir",
+                tmp,
+                slice_file,
+            ]
+        )
+        if status != 0:
+            logging.error("slice2py failed on %s with status %d", slice_file, status)
+            return False
+        name = os.path.splitext(os.path.basename(slice_file))[0] + "_ice.py"
+        os.replace(os.path.join(tmp, name), target)
+    return True
+
+
+def _load_cached(slice_file: str, cache_dir: str) -> bool:
+    os.makedirs(cache_dir, exist_ok=True)
+    digest = _slice_digest(slice_file)
+    target = os.path.join(cache_dir, f"murmur_{digest}.py")
+    if not os.path.exists(target):
+        logging.info("generating slice module %s", target)
+        for stale in glob.glob(os.path.join(cache_dir, "murmur_*.py")):
+            os.remove(stale)
+        # Also the bytecode python cached next to them.
+        for stale in glob.glob(os.path.join(cache_dir, "__pycache__", "murmur_*.pyc")):
+            os.remove(stale)
+        if not _compile(slice_file, cache_dir, target):
+            return False
+    # Loaded from its path, so python also caches the bytecode next to it.
+    spec = importlib.util.spec_from_file_location(f"murmur_{digest}", target)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    # Makes the generated modules importable, like Ice.loadSlice does.
+    Ice.updateModules()
+    return True
+
+
+def load_slice(slice_file: str = SLICE_FILE, cache_dir: Optional[str] = None):
+    global load_seconds
+    start = time.monotonic()
+    if not cache_dir or not _load_cached(slice_file, cache_dir):
+        Ice.loadSlice("-I" + Ice.getSliceDir(), [slice_file])
+    load_seconds = time.monotonic() - start
+    logging.debug("loaded slice definitions in %.3fs", load_seconds)
+
+
+load_slice(cache_dir=os.environ.get(CACHE_ENV))
+import Murmur  # noqa: E402
@@ -0,0 +1,156 @@
+import logging
+import threading
+import time
+from collections import OrderedDict
+from typing import Callable, FrozenSet, List, Optional, Tuple
+
+# Debounces connect and disconnect events of murmur users.
+# The first event of a user opens a window, further events of that user
+# within the window only update it. When the window has passed, the last
+# event is applied. If it is the opposite of the first one (e.g. a
+# disconnect followed by a reconnect) the events cancel out, but the last
+# one is still applied: a message may have joined the user in between, and
+# joining or leaving is a no-op if the user is already in that state. Due
+# changes are applied in batches with a pause in between, so a reconnect of
+# a whole server does not flood matrix.
+
+
+class _Pending:
+    __slots__ = ("rooms", "first", "last", "deadline")
+
+    def __init__(self, rooms: FrozenSet[str], event: str, deadline: float):
+        self.rooms = rooms
+        self.first = event
+        self.last = event
+        self.deadline = deadline
+
+
+class PresenceDebouncer:
+    def __init__(
+        self,
+        window: float = 2.0,
+        batch_size: int = 20,
+        batch_interval: float = 1.0,
+    ):
+        self._window = window
+        self._batch_size = max(1, batch_size)
+        self._batch_interval = batch_interval
+        self._on_change_cb: Optional[Callable[[FrozenSet[str], str, str], None]] = None
+
+        # Ordered by the first event, which is also the order of the deadlines.
+        self._pending: "OrderedDict[str, _Pending]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._wakeup = threading.Condition(self._lock)
+        self._thread: Optional[threading.Thread] = None
+        self._stopped = False
+
+        self._applied = 0
+        self._cancelled = 0
+        self._merged = 0
+
+    @property
+    def on_change_cb(self) -> Callable[[FrozenSet[str], str, str], None]:
+        return self._on_change_cb
+
+    @on_change_cb.setter
+    def on_change_cb(self, cb: Callable[[FrozenSet[str], str, str], None]):
+        self._on_change_cb = cb
+
+    @property
+    def pending(self) -> int:
+        return len(self._pending)
+
+    @property
+    def applied(self) -> int:
+        return self._applied
+
+    @property
+    def cancelled(self) -> int:
+        return self._cancelled
+
+    @property
+    def merged(self) -> int:
+        return self._merged
+
+    def start(self):
+        if self._thread is not None:
+            return
+        self._thread = threading.Thread(target=self._run, name="presence", daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout: Optional[float] = 5.0):
+        with self._lock:
+            self._stopped = True
+            self._wakeup.notify()
+        if self._thread is not None:
+            self._thread.join(timeout)
+            self._thread = None
+        # What is left is applied right away, e.g. so buffered leaves are
+        # not lost.
+        with self._lock:
+            batch = list(self._pending.items())
+            self._pending.clear()
+        self._apply(batch)
+
+    def submit(self, rooms: FrozenSet[str], sender: str, event: str):
+        if self._window > 0:
+            with self._lock:
+                if not self._stopped:
+                    self._add(rooms, sender, event)
+                    return
+        self._apply([(sender, _Pending(rooms, event, 0.0))])
+
+    def _add(self, rooms: FrozenSet[str], sender: str, event: str):
+        pending = self._pending.get(sender)
+        if pending is None:
+            self._pending[sender] = _Pending(
+                rooms, event, time.monotonic() + self._window
+            )
+            self._wakeup.notify()
+        else:
+            # The rooms depend on the channel of the user, the last event
+            # has the current ones.
+            pending.rooms = rooms
+            pending.last = event
+            self._merged += 1
+
+    def _run(self):
+        while True:
+            with self._lock:
+                while not self._stopped:
+                    if self._pending:
+                        timeout = next(iter(self._pending.values())).deadline
+                        timeout -= time.monotonic()
+                        if timeout <= 0:
+                            break
+                    else:
+                        timeout = None
+                    self._wakeup.wait(timeout)
+                if self._stopped:
+                    return
+                batch = self._take_due(time.monotonic())
+            self._apply(batch)
+            if len(batch) == self._batch_size:
+                time.sleep(self._batch_interval)
+
+    def _take_due(self, now: float) -> List[Tuple[str, _Pending]]:
+        batch = []
+        while self._pending and len(batch) < self._batch_size:
+            sender, pending = next(iter(self._pending.items()))
+            if pending.deadline > now:
+                break
+            del self._pending[sender]
+            batch.append((sender, pending))
+        return batch
+
+    def _apply(self, batch: List[Tuple[str, _Pending]]):
+        for sender, pending in batch:
+            if pending.first != pending.last:
+                logging.debug("presence changes of %s cancel out", sender)
+                self._cancelled += 1
+            else:
+                self._applied += 1
+            if self._on_change_cb is not None:
+                self._on_change_cb(pending.rooms, sender, pending.last)
+        if len(batch) > 1:
+            logging.debug("applied a batch of %d presence changes", len(batch))
@@ -0,0 +1,90 @@
+import threading
+from typing import Dict, Optional, Set, Tuple
+
+from storage import Storage
+
+# Remembers which puppets are registered on the matrix server and which rooms
+# they joined. Everything is loaded into sets at startup, so lookups never
+# hit the database or the matrix server.
+
+
+class PuppetRegistry:
+    def __init__(self, storage: Storage):
+        self._storage = storage
+        self._lock = threading.Lock()
+
+        self._storage.execute(
+            "CREATE TABLE IF NOT EXISTS puppets (name TEXT PRIMARY KEY)"
+        )
+        self._storage.execute(
+            "CREATE TABLE IF NOT EXISTS memberships "
+            "(name TEXT, room TEXT, PRIMARY KEY (name, room))"
+        )
+
+        self._registered: Set[str] = {
+            name for (name,) in self._storage.query("SELECT name FROM puppets")
+        }
+        self._joined: Set[Tuple[str, str]] = set(
+            self._storage.query("SELECT name, room FROM memberships")
+        )
+
+    def __len__(self) -> int:
+        return len(self._registered)
+
+    def is_registered(self, name: str) -> bool:
+        return name in self._registered
+
+    def add(self, name: str):
+        with self._lock:
+            if name in self._registered:
+                return
+            self._registered.add(name)
+        self._storage.execute("INSERT OR IGNORE INTO puppets VALUES (?)", (name,))
+
+    def is_joined(self, name: str, room: str) -> bool:
+        return (name, room) in self._joined
+
+    def joined(self, room: str) -> Set[str]:
+        with self._lock:
+            return {name for name, joined_room in self._joined if joined_room == room}
+
+    def set_joined(self, name: str, room: str, joined: bool):
+        with self._lock:
+            if ((name, room) in self._joined) == joined:
+                return
+            if joined:
+                self._joined.add((name, room))
+            else:
+                self._joined.discard((name, room))
+        if joined:
+            self._storage.execute(
+                "INSERT OR IGNORE INTO memberships VALUES (?, ?)", (name, room)
+            )
+        else:
+            self._storage.execute(
+                "DELETE FROM memberships WHERE name = ? AND room = ?", (name, room)
+            )
+
+
+# Remembers the mxc urls of media the bridge uploaded to matrix, keyed by the
+# hash of the content. Images which are posted again reuse the upload.
+
+
+class UploadIndex:
+    def __init__(self, storage: Storage):
+        self._storage = storage
+        self._storage.execute(
+            "CREATE TABLE IF NOT EXISTS uploads (hash TEXT PRIMARY KEY, mxc TEXT)"
+        )
+        self._uploads: Dict[str, str] = dict(
+            self._storage.query("SELECT hash, mxc FROM uploads")
+        )
+
+    def get(self, digest: str) -> Optional[str]:
+        return self._uploads.get(digest)
+
+    def add(self, digest: str, mxc_url: str):
+        self._uploads[digest] = mxc_url
+        self._storage.execute(
+            "INSERT OR REPLACE INTO uploads VALUES (?, ?)", (digest, mxc_url)
+        )
@@ -0,0 +1,34 @@
+import logging
+import sqlite3
+import threading
+from typing import Any, Iterable, List, Sequence
+
+# Small wrapper around a sqlite database which is shared by all
+# components that need to persist state across restarts.
+# The connection is used from multiple threads, so every access is locked.
+
+
+class Storage:
+    def __init__(self, path: str):
+        self._path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        logging.debug("opened database %s", path)
+
+    def execute(self, sql: str, params: Sequence[Any] = ()):
+        with self._lock, self._conn:
+            self._conn.execute(sql, params)
+
+    def executemany(self, sql: str, params: Iterable[Sequence[Any]]):
+        with self._lock, self._conn:
+            self._conn.executemany(sql, params)
+
+    def query(self, sql: str, params: Sequence[Any] = ()) -> List[tuple]:
+        with self._lock:
+            return self._conn.execute(sql, params).fetchall()
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
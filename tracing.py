@@ -0,0 +1,217 @@
+import json
+import logging
+import logging.handlers
+import random
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from typing import Iterator, List, Optional, Tuple
+
+# Traces the way of a message through the bridge. A trace is started where
+# a message enters the bridge (an event of a pushed matrix transaction or a
+# murmur text message) and the timed stages it passes, which are the
+# histograms of the metrics module, are recorded as its spans. The current
+# traces are kept per thread, the work queue, the image pipeline and the
+# coalescer hand them over to the threads which continue the work. A trace
+# is finished when the last stage holding it is done.
+#
+# Finished traces are written to a rotating jsonl file if they are sampled,
+# traces which took longer than the threshold are logged with their spans.
+
+# A span: name, start relative to the trace start and duration, in seconds.
+Span = Tuple[str, float, float]
+
+
+class Trace:
+    __slots__ = ("id", "name", "attrs", "start", "time", "spans", "_holders", "_lock")
+
+    def __init__(self, name: str, attrs: dict):
+        self.id = uuid.uuid4().hex[:16]
+        self.name = name
+        self.attrs = attrs
+        self.start = time.perf_counter()
+        self.time = time.time()
+        self.spans: List[Span] = []
+        self._holders = 1
+        self._lock = threading.Lock()
+
+    def add_span(self, name: str, end: float, duration: float):
+        with self._lock:
+            self.spans.append((name, end - duration - self.start, duration))
+
+    def hold(self):
+        with self._lock:
+            self._holders += 1
+
+    def release(self) -> bool:
+        # Returns True when the last holder released the trace.
+        with self._lock:
+            self._holders -= 1
+            return self._holders == 0
+
+
+class Tracer:
+    def __init__(self):
+        self._enabled = False
+        self._sample_rate = 0.0
+        self._slow_threshold = 0.0
+        self._logger: Optional[logging.Logger] = None
+
+        self._finished = 0
+        self._slow = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self._enabled
+
+    @property
+    def finished(self) -> int:
+        return self._finished
+
+    @property
+    def slow(self) -> int:
+        return self._slow
+
+    def configure(
+        self,
+        path: Optional[str] = None,
+        sample_rate: float = 0.01,
+        slow_threshold: float = 5.0,
+        max_bytes: int = 10 * 1024 * 1024,
+        backups: int = 3,
+    ):
+        self._sample_rate = sample_rate if path else 0.0
+        self._slow_threshold = slow_threshold
+        if path:
+            handler = logging.handlers.RotatingFileHandler(
+                path, maxBytes=max_bytes, backupCount=backups, encoding="utf-8"
+            )
+            handler.setFormatter(logging.Formatter("%(message)s"))
+            self._logger = logging.getLogger("mandm.traces")
+            self._logger.propagate = False
+            self._logger.setLevel(logging.INFO)
+            self._logger.addHandler(handler)
+        self._enabled = self._sample_rate > 0 or self._slow_threshold > 0
+
+    def start(self, name: str, **attrs) -> Optional[Trace]:
+        if not self._enabled:
+            return None
+        return Trace(name, attrs)
+
+    def release(self, trace: Trace):
+        if trace.release():
+            self._finish(trace)
+
+    def _finish(self, trace: Trace):
+        # Traces without spans did not reach any stage, e.g. ignored events.
+        if not trace.spans:
+            return
+        self._finished += 1
+        duration = time.perf_counter() - trace.start
+        spans = sorted(trace.spans, key=lambda span: span[1])
+        if self._slow_threshold > 0 and duration > self._slow_threshold:
+            self._slow += 1
+            logging.warning(
+                "slow %s trace %s took %.3fs: %s",
+                trace.name,
+                trace.id,
+                duration,
+                ", ".join(
+                    f"{name} +{start:.3f}s {length:.3f}s"
+                    for name, start, length in spans
+                ),
+            )
+        if self._logger is not None and random.random() < self._sample_rate:
+            record = {
+                "id": trace.id,
+                "name": trace.name,
+                "time": round(trace.time, 6),
+                "duration": round(duration, 6),
+                "attrs": trace.attrs,
+                "spans": [
+                    {
+                        "name": name,
+                        "start": round(start, 6),
+                        "duration": round(length, 6),
+                    }
+                    for name, start, length in spans
+                ],
+            }
+            self._logger.info(json.dumps(record))
+
+
+TRACER = Tracer()
+
+_local = threading.local()
+
+
+def current() -> Tuple[Trace, ...]:
+    return getattr(_local, "traces", ())
+
+
+@contextmanager
+def trace(name: str, **attrs) -> Iterator[Optional[Trace]]:
+    # Starts a trace which is current within the block.
+    started = TRACER.start(name, **attrs)
+    if started is None:
+        yield None
+        return
+    previous = current()
+    _local.traces = (started,)
+    try:
+        yield started
+    finally:
+        _local.traces = previous
+        TRACER.release(started)
+
+
+def capture() -> Tuple[Trace, ...]:
+    # Holds the current traces, to continue them in another thread with
+    # activate, or to let them go with release.
+    traces = current()
+    for held in traces:
+        held.hold()
+    return traces
+
+
+@contextmanager
+def activate(traces: Tuple[Trace, ...]) -> Iterator[None]:
+    # Makes captured traces current within the block and releases them.
+    if not traces:
+        yield
+        return
+    previous = current()
+    _local.traces = traces
+    try:
+        yield
+    finally:
+        _local.traces = previous
+        release(traces)
+
+
+def release(traces: Tuple[Trace, ...]):
+    for held in traces:
+        TRACER.release(held)
+
+
+def record(name: str, duration: float):
+    # Adds a span which just ended to the current traces.
+    traces = current()
+    if not traces:
+        return
+    end = time.perf_counter()
+    for held in traces:
+        held.add_span(name, end, duration)
+
+
+@contextmanager
+def span(name: str) -> Iterator[None]:
+    if not current():
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record(name, time.perf_counter() - start)
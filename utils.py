@@ -1,28 +1,58 @@
+import base64
+import binascii
 import io
+import re
 from configparser import ConfigParser
-from typing import Callable, List, Tuple
+from typing import Dict, List, Optional, Tuple
+from urllib.parse import unquote_to_bytes
 
 import yaml
 from PIL import Image
 
-from msghandlers import MsgHandlers
+from msghandlers import Handler, HandlerLoader
+
+DATA_IMAGE_RE = re.compile(
+    rb'<img\s[^>]*?src="data:(image/[\w.+-]+);base64,([^"]*)"[^>]*>', re.IGNORECASE
+)
 
 
 def load_enabled_msg_handlers(
-    config: ConfigParser,
-) -> List[Callable[[str, str], Tuple[bool, str]]]:
-    message_handlers = [
-        method_name
-        for method_name in dir(MsgHandlers)
-        if callable(getattr(MsgHandlers, method_name))
-        and not method_name.startswith("__")
-    ]
-    enabled_handlers = [
-        handler_name for handler_name in config if handler_name in message_handlers
-    ]
+    config: ConfigParser, message_handlers: Dict[str, HandlerLoader]
+) -> Dict[str, Handler]:
+    # Loads the handlers which have a section in the config, in its order.
+    enabled_handlers = {}
+    for handler_name in config:
+        if handler_name not in message_handlers:
+            continue
+        handler = message_handlers[handler_name]()
+        if handler is not None:
+            enabled_handlers[handler_name] = handler
     return enabled_handlers
 
 
+def load_room_routes(config: ConfigParser) -> Dict[int, Dict[Optional[str], str]]:
+    # Returns the matrix room of every bridged murmur channel, per server id.
+    # The room of [appservice] gets the channels of [murmur], further rooms
+    # are configured in [room:<alias>] sections.
+    room = config["appservice"]["Room"]
+    server_id = int(config["murmur"]["ServerId"])
+    routes: Dict[int, Dict[Optional[str], str]] = {server_id: {}}
+    if "BridgedChannels" in config["murmur"]:
+        for channel in config["murmur"]["BridgedChannels"].split(","):
+            routes[server_id][channel] = room
+    else:
+        routes[server_id][None] = room
+
+    for section in config.sections():
+        if not section.startswith("room:"):
+            continue
+        room = section[len("room:") :]
+        for channel in config[section]["Channels"].split(","):
+            server, _, name = channel.strip().partition(":")
+            routes.setdefault(int(server), {})[name or None] = room
+    return routes
+
+
 def generate_appservice_config(config_file: str) -> str:
     config = ConfigParser()
     config.read(config_file)
@@ -31,7 +61,9 @@ def generate_appservice_config(config_file: str) -> str:
     service_ip = config["appservice"]["ApplicationServiceIP"]
     as_token = config["appservice"]["ApplicationServiceToken"]
     hs_token = config["appservice"]["HomeserverToken"]
-    room = config["appservice"]["Room"]
+    rooms = {
+        room for routes in load_room_routes(config).values() for room in routes.values()
+    }
     user_prefix = config["appservice"]["UserPrefix"]
 
     yaml_config = {
@@ -43,18 +75,131 @@ def generate_appservice_config(config_file: str) -> str:
         "namespaces": {
             "users": [{"exclusive": True, "regex": "@" + user_prefix + ".*"}],
             "rooms": [],
-            "aliases": [{"exclusive": True, "regex": f"#{room}"}],
+            "aliases": [
+                {"exclusive": True, "regex": f"#{room}"} for room in sorted(rooms)
+            ],
         },
     }
 
     return yaml.dump(yaml_config)
 
 
-def ensure_image_size(
-    image: bytes, format: str, max_width: int = 600, max_height: int = 450
-) -> bytes:
+# Range of the jpeg quality searched to fit an image into the byte budget.
+JPEG_QUALITY_MAX = 75
+JPEG_QUALITY_MIN = 30
+# How often an image which does not fit at the lowest quality is scaled down.
+MAX_DOWNSCALES = 4
+
+
+def fit_image(
+    image: bytes,
+    format: str,
+    max_size: Optional[Tuple[int, int]] = (600, 450),
+    max_bytes: int = 0,
+) -> Tuple[bytes, str]:
+    # Returns the image scaled down to max_size and encoded into at most
+    # max_bytes (0 for no limit), and its format. Jpegs and pngs which already
+    # fit are returned as they are, whatever format was asked for. Jpegs are
+    # decoded at a reduced scale right away, the quality of jpegs is searched
+    # to fit the budget and a photo which does not fit as png becomes a jpeg.
     img = Image.open(io.BytesIO(image))
-    img.thumbnail((max_width, max_height), Image.Resampling.LANCZOS)
+    fits_size = max_size is None or (
+        img.width <= max_size[0] and img.height <= max_size[1]
+    )
+    actual_format = (img.format or "").lower()
+    if (
+        fits_size
+        and actual_format in ("jpeg", "png")
+        and (not max_bytes or len(image) <= max_bytes)
+    ):
+        return image, actual_format
+
+    if not fits_size:
+        if img.format == "JPEG":
+            # Lets the decoder skip the pixels which are scaled away anyway.
+            img.draft("RGB", max_size)
+        img.thumbnail(max_size, Image.Resampling.BICUBIC, reducing_gap=1.5)
+
+    if format == "png":
+        data = _encode(img, "png")
+        if not max_bytes or len(data) <= max_bytes:
+            return data, "png"
+        if img.mode in ("RGBA", "LA", "P"):
+            # Transparency would get lost as jpeg, a palette keeps it.
+            return _fit_png(img.convert("RGBA").quantize(256), max_bytes), "png"
+    return _fit_jpeg(img, max_bytes), "jpeg"
+
+
+def _encode(img: Image.Image, format: str, **params) -> bytes:
     with io.BytesIO() as output:
-        img.save(output, format=format)
+        img.save(output, format=format, **params)
         return output.getvalue()
+
+
+def _fit_jpeg(img: Image.Image, max_bytes: int) -> bytes:
+    if img.mode != "RGB":
+        img = img.convert("RGB")
+    data = _encode(img, "jpeg", quality=JPEG_QUALITY_MAX)
+    for _ in range(MAX_DOWNSCALES + 1):
+        if not max_bytes or len(data) <= max_bytes:
+            return data
+        # Binary search for the highest quality which fits.
+        low, high = JPEG_QUALITY_MIN, JPEG_QUALITY_MAX - 1
+        best = None
+        while low <= high:
+            quality = (low + high) // 2
+            candidate = _encode(img, "jpeg", quality=quality)
+            if len(candidate) <= max_bytes:
+                best = candidate
+                low = quality + 1
+            else:
+                data = candidate
+                high = quality - 1
+        if best is not None:
+            return best
+        img = _downscale(img, max_bytes / len(data))
+        data = _encode(img, "jpeg", quality=JPEG_QUALITY_MAX)
+    return data
+
+
+def _fit_png(img: Image.Image, max_bytes: int) -> bytes:
+    data = _encode(img, "png")
+    for _ in range(MAX_DOWNSCALES):
+        if len(data) <= max_bytes:
+            break
+        img = _downscale(img, max_bytes / len(data))
+        data = _encode(img, "png")
+    return data
+
+
+def _downscale(img: Image.Image, ratio: float) -> Image.Image:
+    # The encoded size shrinks roughly with the number of pixels.
+    scale = max(0.1, min(0.9, (ratio**0.5) * 0.9))
+    size = (max(1, int(img.width * scale)), max(1, int(img.height * scale)))
+    return img.resize(size, Image.Resampling.BICUBIC)
+
+
+def extract_data_images(msg: str) -> Tuple[str, List[Tuple[str, bytes]]]:
+    # Murmur embeds images as (percent encoded) base64 data URIs. The message
+    # is encoded once and the image payloads are decoded straight from views
+    # into that buffer, so big messages are not copied for every image.
+    raw = msg.encode("utf-8")
+    if b"data:image/" not in raw:
+        return msg, []
+    view = memoryview(raw)
+    images = []
+    text_parts = []
+    pos = 0
+    for match in DATA_IMAGE_RE.finditer(raw):
+        text_parts.append(view[pos : match.start()])
+        pos = match.end()
+        payload = view[match.start(2) : match.end(2)]
+        if raw.find(b"%", match.start(2), match.end(2)) != -1:
+            payload = unquote_to_bytes(payload.tobytes())
+        try:
+            data = base64.b64decode(payload)
+        except binascii.Error:
+            continue
+        images.append((match.group(1).decode("ascii").lower(), data))
+    text_parts.append(view[pos:])
+    return b"".join(text_parts).decode("utf-8"), images
@@ -0,0 +1,111 @@
+import logging
+import queue
+import threading
+import time
+import zlib
+from typing import Callable, List, Optional
+
+import tracing
+
+# Runs jobs on a fixed pool of worker threads.
+# Jobs submitted with the same key always land on the same worker, so their
+# order is kept (e.g. all messages of one puppet). Each worker has a bounded
+# queue, if it is full the job gets dropped instead of blocking the caller.
+# The traces of the submitter are continued by the worker.
+
+
+class KeyedWorkQueue:
+    def __init__(self, workers: int = 4, max_size: int = 1000, name: str = "send"):
+        self._name = name
+        self._queues: List[queue.Queue] = [
+            queue.Queue(max(1, max_size)) for _ in range(max(1, workers))
+        ]
+        self._threads: List[threading.Thread] = []
+
+        self._lock = threading.Lock()
+        self._submitted = 0
+        self._dropped = 0
+
+    @property
+    def depth(self) -> int:
+        return sum(q.qsize() for q in self._queues)
+
+    @property
+    def submitted(self) -> int:
+        return self._submitted
+
+    @property
+    def dropped(self) -> int:
+        return self._dropped
+
+    def start(self):
+        if self._threads:
+            return
+        for i, q in enumerate(self._queues):
+            thread = threading.Thread(
+                target=self._work, args=(q,), name=f"{self._name}-{i}", daemon=True
+            )
+            thread.start()
+            self._threads.append(thread)
+        logging.debug("started %d %s workers", len(self._threads), self._name)
+
+    def stop(self, timeout: Optional[float] = 5.0):
+        # Queued jobs are still run, unless a queue stays full until the
+        # timeout, then its jobs are dropped to make room for the stop.
+        deadline = None if timeout is None else time.monotonic() + timeout
+        for q in self._queues:
+            remaining = (
+                None if deadline is None else max(0, deadline - time.monotonic())
+            )
+            try:
+                q.put(None, timeout=remaining)
+            except queue.Full:
+                self._drain(q)
+                q.put_nowait(None)
+        for thread in self._threads:
+            remaining = (
+                None if deadline is None else max(0, deadline - time.monotonic())
+            )
+            thread.join(remaining)
+        self._threads = []
+
+    def _drain(self, q: queue.Queue):
+        dropped = 0
+        while True:
+            try:
+                _, traces, _ = q.get_nowait()
+            except queue.Empty:
+                break
+            tracing.release(traces)
+            dropped += 1
+        with self._lock:
+            self._dropped += dropped
+        logging.warning("dropped %d %s jobs while stopping", dropped, self._name)
+
+    def submit(self, key: str, job: Callable[[], None]) -> bool:
+        q = self._queues[zlib.crc32(key.encode("utf-8")) % len(self._queues)]
+        traces = tracing.capture()
+        try:
+            q.put_nowait((job, traces, time.perf_counter()))
+        except queue.Full:
+            tracing.release(traces)
+            with self._lock:
+                self._dropped += 1
+            logging.warning("%s queue is full, dropping job for %s", self._name, key)
+            return False
+        with self._lock:
+            self._submitted += 1
+        return True
+
+    def _work(self, q: queue.Queue):
+        while True:
+            item = q.get()
+            if item is None:
+                return
+            job, traces, submitted = item
+            with tracing.activate(traces):
+                tracing.record(f"{self._name}_queue", time.perf_counter() - submitted)
+                try:
+                    job()
+                except Exception:
+                    logging.exception("%s job failed", self._name)